@@ -0,0 +1,315 @@
+'''
+Cache for aggregates of filtered querysets with incremental maintenance.
+
+Results of `QuerySet.aggregate` are cached by the filtered query and the
+aggregate specification::
+
+    vote_stats = AggregateCache(Choice, dependencies=(Poll,))
+    vote_stats.connect()
+
+    stats = vote_stats.aggregate(filtered_choices, {'total': Sum('votes')})
+
+Cached results are kept up to date without rescanning the table when rows
+are inserted or deleted, if every aggregate is decomposable: `Count`,
+`Sum`, `Min`, `Max` and `Avg` (maintained as sum and count) over a local
+field, without `distinct`. Deleting a row equal to the cached minimum or
+maximum drops the result, since the next value is unknown. Other changes
+(updates, changes of models from `dependencies`) drop all cached results of
+the model.
+
+Cached results are stamped with a version of the model's data, which is
+incremented before and after each change. Results are maintained only if
+nothing else changed in between; otherwise (and if their keys are lost from
+the list of maintained results) they become stale and are recomputed.
+'''
+import cPickle as pickle
+
+from django.db.models import signals, Count, Sum
+from django.db.models.query import QuerySet
+from django.utils.datastructures import SortedDict
+
+from datafilters.batch import get_pk_column, in_condition
+from datafilters.cache import bump_version, describe_aggregates, \
+    describe_queryset, get_filter_cache, get_version, make_key
+
+__all__ = ('AggregateCache',)
+
+DECOMPOSABLE_AGGREGATES = ('Count', 'Sum', 'Min', 'Max', 'Avg')
+
+
+class AggregateCache(object):
+    '''
+    Aggregates of querysets of `model` cached for `timeout` seconds.
+    Call `connect` to maintain them on model signals.
+    '''
+
+    def __init__(self, model, timeout=None, dependencies=()):
+        self.model = model
+        self.timeout = timeout
+        self.dependencies = dependencies
+        opts = model._meta
+        self.name = '%s.%s' % (opts.app_label, opts.object_name)
+
+    def get_version_key(self):
+        return 'datafilters:aggregates:version:%s' % self.name
+
+    def get_registry_key(self):
+        return 'datafilters:aggregates:registry:%s' % self.name
+
+    def get_key(self, queryset, aggregate_args):
+        return make_key('aggregates', self.name,
+                        describe_queryset(queryset),
+                        describe_aggregates(aggregate_args))
+
+    def is_decomposable(self, aggregate):
+        if aggregate.name not in DECOMPOSABLE_AGGREGATES:
+            return False
+        if aggregate.extra.get('distinct'):
+            return False
+        return (aggregate.lookup == 'pk' or
+                (aggregate.lookup in self.model._meta.get_all_field_names() and
+                 self.get_attname(aggregate.lookup) is not None))
+
+    def get_attname(self, lookup):
+        if lookup == 'pk':
+            return self.model._meta.pk.attname
+        field = self.model._meta.get_field_by_name(lookup)[0]
+        # Reverse relations have no column
+        return getattr(field, 'attname', None)
+
+    def aggregate(self, queryset, aggregate_args):
+        '''
+        Return `queryset.aggregate(**aggregate_args)`, cached.
+        '''
+        cache = get_filter_cache()
+        key = self.get_key(queryset, aggregate_args)
+        version = get_version(self.get_version_key())
+        entry = cache.get(key)
+        if entry is not None and entry['version'] == version:
+            return entry['values']
+
+        decomposable = (queryset.model is self.model and
+                all(self.is_decomposable(aggregate)
+                    for aggregate in aggregate_args.values()))
+        query_args = dict(aggregate_args)
+        if decomposable:
+            # Sums are maintained with number of summed values, averages
+            # as sum and count
+            for alias, aggregate in aggregate_args.items():
+                lookup = aggregate.lookup
+                if aggregate.name in ('Sum', 'Avg'):
+                    query_args['datafilters_%s_count' % alias] = Count(lookup)
+                if aggregate.name == 'Avg':
+                    query_args['datafilters_%s_sum' % alias] = Sum(lookup)
+        values = queryset.aggregate(**query_args)
+
+        entry = {
+            'version': version,
+            'values': dict((alias, values[alias]) for alias in aggregate_args),
+            'decomposable': decomposable,
+        }
+        if decomposable:
+            entry['query'] = pickle.dumps(queryset.query,
+                                          pickle.HIGHEST_PROTOCOL)
+            entry['aggregates'] = [
+                (alias, aggregate.name, aggregate.lookup)
+                for alias, aggregate in aggregate_args.items()]
+            entry['counts'] = dict(
+                (alias, values['datafilters_%s_count' % alias])
+                for alias, aggregate in aggregate_args.items()
+                if aggregate.name in ('Sum', 'Avg'))
+            entry['sums'] = dict(
+                (alias, values['datafilters_%s_sum' % alias])
+                for alias, aggregate in aggregate_args.items()
+                if aggregate.name == 'Avg')
+
+        # The query may or may not see changes made while it ran
+        if get_version(self.get_version_key()) == version:
+            cache.set(key, entry, self.timeout)
+            self.register(key)
+        return entry['values']
+
+    def register(self, key):
+        # Keys lost by concurrent registrations are not maintained, their
+        # results become stale on the next change
+        cache = get_filter_cache()
+        keys = cache.get(self.get_registry_key()) or []
+        if key not in keys:
+            keys.append(key)
+            cache.set(self.get_registry_key(), keys, self.timeout)
+
+    def invalidate(self):
+        bump_version(self.get_version_key())
+
+    def begin_change(self, instance):
+        '''
+        Mark the start of a change of `instance` and return its state.
+        Results computed while the change is in progress are not cached.
+        '''
+        change = {'pending': bump_version(self.get_version_key())}
+        instance.__dict__.setdefault('_datafilters_aggregates', {})[
+            self.name] = change
+        return change
+
+    def get_entries(self, version):
+        '''
+        Return list of (key, entry) of maintained results computed at
+        `version`.
+        '''
+        cache = get_filter_cache()
+        keys = cache.get(self.get_registry_key()) or []
+        entries = []
+        for key in keys:
+            entry = cache.get(key)
+            if (entry is not None and entry['version'] == version and
+                    entry['decomposable']):
+                entries.append((key, entry))
+        if len(entries) != len(keys):
+            cache.set(self.get_registry_key(), [k for k, _e in entries],
+                      self.timeout)
+        return entries
+
+    def match_keys(self, entries, instance, chunk_size=50):
+        '''
+        Return set of keys of `entries` whose queries include `instance`,
+        matched in one query per `chunk_size` entries.
+        '''
+        # Rows are matched on the database the instance is written to, as
+        # a replica may not have it yet
+        using = instance._state.db
+        base = self.model._default_manager.using(using).filter(pk=instance.pk)
+        pk_column = get_pk_column(base)
+        matched = set()
+        for start in range(0, len(entries), chunk_size):
+            chunk = entries[start:start + chunk_size]
+            select = SortedDict()
+            select_params = []
+            for i, (_key, entry) in enumerate(chunk):
+                queryset = QuerySet(model=self.model,
+                                    query=pickle.loads(entry['query']),
+                                    using=using)
+                condition = in_condition(queryset, pk_column, using)
+                if condition is None:
+                    condition = ('0', ())
+                select['datafilters_match_%d' % i] = condition[0]
+                select_params.extend(condition[1])
+            rows = base.extra(select=select, select_params=select_params) \
+                .values_list(*select.keys())
+            for row in rows:
+                matched.update(key for (key, _entry), flag in zip(chunk, row)
+                               if flag)
+        return matched
+
+    def match_entries(self, change, instance):
+        '''
+        Find results computed before the `change` of `instance` started
+        and keys of those including the instance.
+        '''
+        change['entries'] = self.get_entries(change['pending'] - 1)
+        change['matched'] = self.match_keys(change['entries'], instance)
+
+    def finish_change(self, instance, sign):
+        '''
+        Finish the change of `instance`: add it to (`sign` 1) or subtract
+        it from (`sign` -1) matched results and stamp results that are
+        still valid with the new version.
+        '''
+        change = instance.__dict__.get('_datafilters_aggregates', {}).pop(
+            self.name, None)
+        version = bump_version(self.get_version_key())
+        if change is None or version != change['pending'] + 1:
+            # Another change was made concurrently
+            return
+
+        cache = get_filter_cache()
+        for key, entry in change['entries']:
+            if key in change['matched']:
+                patched = True
+                for alias, name, lookup in entry['aggregates']:
+                    value = getattr(instance, self.get_attname(lookup))
+                    patched = (self.apply_delta(entry, alias, name, value,
+                                                sign) and patched)
+                if not patched:
+                    continue
+            entry['version'] = version
+            cache.set(key, entry, self.timeout)
+
+    def apply_insert(self, instance):
+        '''
+        Update cached results that include the new `instance`.
+        '''
+        change = instance.__dict__.get('_datafilters_aggregates', {}).get(
+            self.name)
+        if change is not None:
+            self.match_entries(change, instance)
+        self.finish_change(instance, 1)
+
+    def apply_delta(self, entry, alias, name, value, sign=1):
+        '''
+        Add (`sign` 1) or subtract (`sign` -1) `value` to the aggregate
+        under `alias`. Return `False` if the result can't be updated.
+        '''
+        values = entry['values']
+        current = values[alias]
+        if value is None:
+            return True
+        if name == 'Count':
+            values[alias] = (current or 0) + sign
+        elif name in ('Sum', 'Avg'):
+            count = (entry['counts'][alias] or 0) + sign
+            entry['counts'][alias] = count
+            if name == 'Sum':
+                total = values[alias] = (current or 0) + sign * value
+            else:
+                total = entry['sums'][alias] = \
+                    (entry['sums'][alias] or 0) + sign * value
+                values[alias] = float(total) / count if count else None
+            if not count:
+                values[alias] = None
+        elif sign < 0:
+            # The next minimum or maximum is unknown
+            if current is None or value == current:
+                return False
+        elif name == 'Min':
+            values[alias] = value if current is None else min(current, value)
+        elif name == 'Max':
+            values[alias] = value if current is None else max(current, value)
+        return True
+
+    def connect(self):
+        '''
+        Subscribe to model signals for incremental maintenance.
+        '''
+        uid = 'datafilters-aggregates-%s' % self.name
+        signals.pre_save.connect(self._on_pre_change, sender=self.model,
+                                 weak=False, dispatch_uid=uid)
+        signals.post_save.connect(self._on_save, sender=self.model,
+                                  weak=False, dispatch_uid=uid)
+        signals.pre_delete.connect(self._on_pre_delete, sender=self.model,
+                                   weak=False, dispatch_uid=uid)
+        signals.post_delete.connect(self._on_delete, sender=self.model,
+                                    weak=False, dispatch_uid=uid)
+        for model in self.dependencies:
+            signals.post_save.connect(self._on_change, sender=model,
+                                      weak=False, dispatch_uid=uid)
+            signals.post_delete.connect(self._on_change, sender=model,
+                                        weak=False, dispatch_uid=uid)
+
+    def _on_pre_change(self, sender, instance, **kwargs):
+        self.begin_change(instance)
+
+    def _on_save(self, sender, instance, created=False, **kwargs):
+        if created:
+            self.apply_insert(instance)
+        else:
+            self.invalidate()
+
+    def _on_pre_delete(self, sender, instance, **kwargs):
+        # The row is matched while it still exists
+        self.match_entries(self.begin_change(instance), instance)
+
+    def _on_delete(self, sender, instance, **kwargs):
+        self.finish_change(instance, -1)
+
+    def _on_change(self, sender, **kwargs):
+        self.invalidate()
@@ -0,0 +1,334 @@
+'''
+Usage and latency statistics of filter spec combinations.
+
+Set `stats_collector` of a filter form to record how often each combination
+of active specs is used and how long its queries take::
+
+    poll_stats = FilterStatsCollector(SQLiteStatsStorage('/var/tmp/stats.db'))
+
+    class PollsFilterForm(FilterForm):
+        stats_collector = poll_stats
+        ...
+
+Combinations are identified by a fingerprint of active spec names and
+types of their values (raw values are never recorded). Statistics are kept
+in memory and merged into the storage every `flush_interval` seconds; print
+them with `manage.py filter_stats`.
+'''
+import itertools
+import sqlite3
+import threading
+import time
+import weakref
+
+from django.db.models.query import DateQuerySet, EmptyQuerySet, QuerySet, \
+    ValuesListQuerySet, ValuesQuerySet
+
+from datafilters.cache import get_filter_cache
+
+__all__ = (
+    'CacheStatsStorage',
+    'FilterStatsCollector',
+    'SQLiteStatsStorage',
+    'fingerprint',
+)
+
+# Upper bounds of latency buckets, in milliseconds
+DEFAULT_BUCKETS = (10, 50, 100, 250, 500, 1000, 5000)
+# Bucket of queries slower than the last bound
+OVERFLOW = 'inf'
+
+# Querysets refer to collectors by ids, so they don't carry collectors (and
+# their locks) in their state
+_collectors = weakref.WeakValueDictionary()
+_collector_ids = itertools.count()
+
+
+def value_shape(value):
+    if isinstance(value, (list, tuple)):
+        return '%s[%d]' % (type(value).__name__, len(value))
+    return type(value).__name__
+
+
+def fingerprint(filterform):
+    '''
+    Return a string identifying the combination of active specs of a valid
+    filter form: spec names with types of their values.
+    '''
+    return '&'.join('%s:%s' % (name, value_shape(value))
+                    for name, (value, _lookup)
+                    in sorted(filterform.active_specs.items()))
+
+
+def empty_stats():
+    return {
+        'uses': 0,
+        'queries': 0,
+        'total_time': 0.0,
+        'max_time': 0.0,
+        'histogram': {},
+    }
+
+
+def merge_stats(stats, other):
+    stats['uses'] += other['uses']
+    stats['queries'] += other['queries']
+    stats['total_time'] += other['total_time']
+    stats['max_time'] = max(stats['max_time'], other['max_time'])
+    for bucket, hits in other['histogram'].items():
+        stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + hits
+
+
+class SQLiteStatsStorage(object):
+    '''
+    Keep statistics in a local SQLite database at `path`.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('CREATE TABLE IF NOT EXISTS filter_stats ('
+                           'fingerprint TEXT PRIMARY KEY, '
+                           'uses INTEGER, queries INTEGER, '
+                           'total_time REAL, max_time REAL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS filter_latency ('
+                           'fingerprint TEXT, bucket TEXT, hits INTEGER, '
+                           'PRIMARY KEY (fingerprint, bucket))')
+        return connection
+
+    def save(self, stats_by_fingerprint):
+        connection = self.connect()
+        try:
+            with connection:
+                for key, stats in stats_by_fingerprint.items():
+                    connection.execute(
+                        'INSERT OR IGNORE INTO filter_stats '
+                        'VALUES (?, 0, 0, 0, 0)', (key,))
+                    connection.execute(
+                        'UPDATE filter_stats SET uses = uses + ?, '
+                        'queries = queries + ?, '
+                        'total_time = total_time + ?, '
+                        'max_time = max(max_time, ?) WHERE fingerprint = ?',
+                        (stats['uses'], stats['queries'],
+                         stats['total_time'], stats['max_time'], key))
+                    for bucket, hits in stats['histogram'].items():
+                        connection.execute(
+                            'INSERT OR IGNORE INTO filter_latency '
+                            'VALUES (?, ?, 0)', (key, str(bucket)))
+                        connection.execute(
+                            'UPDATE filter_latency SET hits = hits + ? '
+                            'WHERE fingerprint = ? AND bucket = ?',
+                            (hits, key, str(bucket)))
+        finally:
+            connection.close()
+
+    def load(self):
+        connection = self.connect()
+        try:
+            result = {}
+            for row in connection.execute('SELECT * FROM filter_stats'):
+                key, uses, queries, total_time, max_time = row
+                result[key] = {
+                    'uses': uses,
+                    'queries': queries,
+                    'total_time': total_time,
+                    'max_time': max_time,
+                    'histogram': {},
+                }
+            for key, bucket, hits in connection.execute(
+                    'SELECT * FROM filter_latency'):
+                if bucket != OVERFLOW:
+                    bucket = int(bucket)
+                result[key]['histogram'][bucket] = hits
+            return result
+        finally:
+            connection.close()
+
+
+class CacheStatsStorage(object):
+    '''
+    Keep statistics in the datafilters cache (see `datafilters.cache`).
+
+    Updates are not atomic, so concurrent flushes of several processes can
+    lose some samples.
+    '''
+
+    key = 'datafilters:stats'
+
+    def __init__(self, cache=None, timeout=None):
+        self.cache = cache if cache is not None else get_filter_cache()
+        self.timeout = timeout
+
+    def save(self, stats_by_fingerprint):
+        result = self.load()
+        for key, stats in stats_by_fingerprint.items():
+            merge_stats(result.setdefault(key, empty_stats()), stats)
+        self.cache.set(self.key, result, self.timeout)
+
+    def load(self):
+        return self.cache.get(self.key) or {}
+
+
+class FilterStatsCollector(object):
+    '''
+    Collect statistics of filter forms in memory and flush them to
+    `storage` (cache by default) every `flush_interval` seconds.
+    '''
+
+    def __init__(self, storage=None, flush_interval=60,
+            buckets=DEFAULT_BUCKETS):
+        self.storage = storage if storage is not None else CacheStatsStorage()
+        self.flush_interval = flush_interval
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.last_flush = time.time()
+        self.id = next(_collector_ids)
+        _collectors[self.id] = self
+
+    def get_bucket(self, milliseconds):
+        for bound in self.buckets:
+            if milliseconds <= bound:
+                return bound
+        return OVERFLOW
+
+    def _get_stats(self, key):
+        if key not in self.stats:
+            self.stats[key] = empty_stats()
+        return self.stats[key]
+
+    def record_use(self, key):
+        with self.lock:
+            self._get_stats(key)['uses'] += 1
+        self.maybe_flush()
+
+    def record_query(self, key, seconds):
+        bucket = self.get_bucket(seconds * 1000)
+        with self.lock:
+            stats = self._get_stats(key)
+            stats['queries'] += 1
+            stats['total_time'] += seconds
+            stats['max_time'] = max(stats['max_time'], seconds)
+            stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            stats, self.stats = self.stats, {}
+            self.last_flush = time.time()
+        if stats:
+            self.storage.save(stats)
+
+    def track(self, filterform, queryset):
+        '''
+        Record use of the form's spec combination and return `queryset`
+        recording latency of its queries.
+        '''
+        key = fingerprint(filterform)
+        self.record_use(key)
+        return queryset._clone(klass=get_timed_class(queryset.__class__),
+                               _stats=(self.id, key))
+
+
+def _restore_timed(queryset_cls):
+    timed_cls = get_timed_class(queryset_cls)
+    return timed_cls.__new__(timed_cls)
+
+
+class TimedQuerySetMixin(object):
+    '''
+    Queryset mixin recording evaluation time of queries to a
+    `FilterStatsCollector` (stored in `_stats` as collector id with the
+    fingerprint).
+    '''
+
+    _stats = None
+
+    def __reduce__(self):
+        # Timed classes of custom querysets are created at runtime, so they
+        # are pickled by their base class. Unpickled querysets are not timed
+        state = self.__getstate__()
+        state.pop('_stats', None)
+        base_cls = [cls for cls in self.__class__.__mro__
+                    if not issubclass(cls, TimedQuerySetMixin)][0]
+        return _restore_timed, (base_cls,), state
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        if klass is not None:
+            klass = get_timed_class(klass)
+        kwargs.setdefault('_stats', self._stats)
+        return super(TimedQuerySetMixin, self)._clone(klass, setup, **kwargs)
+
+    def _record(self, started):
+        if self._stats is None:
+            return
+        collector_id, key = self._stats
+        collector = _collectors.get(collector_id)
+        if collector is not None:
+            collector.record_query(key, time.time() - started)
+
+    def iterator(self):
+        started = time.time()
+        try:
+            for row in super(TimedQuerySetMixin, self).iterator():
+                yield row
+        finally:
+            self._record(started)
+
+    def count(self):
+        if self._result_cache is not None:
+            return super(TimedQuerySetMixin, self).count()
+        started = time.time()
+        try:
+            return super(TimedQuerySetMixin, self).count()
+        finally:
+            self._record(started)
+
+    def aggregate(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return super(TimedQuerySetMixin, self).aggregate(*args, **kwargs)
+        finally:
+            self._record(started)
+
+
+class TimedQuerySet(TimedQuerySetMixin, QuerySet):
+    pass
+
+
+class TimedValuesQuerySet(TimedQuerySetMixin, ValuesQuerySet):
+    pass
+
+
+class TimedValuesListQuerySet(TimedQuerySetMixin, ValuesListQuerySet):
+    pass
+
+
+class TimedDateQuerySet(TimedQuerySetMixin, DateQuerySet):
+    pass
+
+
+_timed_classes = {
+    QuerySet: TimedQuerySet,
+    ValuesQuerySet: TimedValuesQuerySet,
+    ValuesListQuerySet: TimedValuesListQuerySet,
+    DateQuerySet: TimedDateQuerySet,
+}
+
+
+def get_timed_class(queryset_cls):
+    # Empty querysets don't run queries
+    if issubclass(queryset_cls, (TimedQuerySetMixin, EmptyQuerySet)):
+        return queryset_cls
+    if queryset_cls not in _timed_classes:
+        # Custom querysets
+        _timed_classes[queryset_cls] = type(
+            'Timed%s' % queryset_cls.__name__,
+            (TimedQuerySetMixin, queryset_cls), {})
+    return _timed_classes[queryset_cls]
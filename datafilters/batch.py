@@ -0,0 +1,90 @@
+'''
+Batch evaluation of many filter forms against a set of rows.
+
+Useful for saved filters (alerts): instead of one query per saved filter,
+rows are checked against a chunk of filters in one query, with a
+conditional column per filter::
+
+    forms = dict((alert.pk, AlertFilterForm(QueryDict(alert.querystring)))
+                 for alert in alerts)
+    matches = match_filters(forms, Poll.objects.filter(pk__in=new_ids))
+    # {poll_pk: [alert_pk, ...], ...}
+'''
+from django.db import connections
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.datastructures import SortedDict
+
+__all__ = ('match_filters',)
+
+
+def get_pk_column(queryset):
+    qn = connections[queryset.db].ops.quote_name
+    opts = queryset.model._meta
+    return '%s.%s' % (qn(opts.db_table), qn(opts.pk.column))
+
+
+def in_condition(subqueryset, pk_column, using):
+    '''
+    Return SQL condition (with params) that is true for rows with primary
+    key in `subqueryset`, or `None` if nothing can match.
+    '''
+    subquery = subqueryset.values('pk').query
+    try:
+        sql, params = subquery.get_compiler(using=using).as_sql()
+    except EmptyResultSet:
+        return None
+    condition = 'CASE WHEN %s IN (%s) THEN 1 ELSE 0 END' % (pk_column, sql)
+    return condition, params
+
+
+def _match_condition(filterform, queryset, pk_column):
+    '''
+    Return SQL condition (with params) that is true for rows of
+    `queryset` matching `filterform`, or `None` if nothing can match.
+    '''
+    base = queryset.model._default_manager.using(queryset.db)
+    return in_condition(filterform.filter(base.all()), pk_column,
+                        queryset.db)
+
+
+def match_filters(filterforms, queryset, chunk_size=50):
+    '''
+    Return mapping of primary keys of `queryset` rows to lists of keys of
+    matching filter forms.
+
+    `filterforms` is a mapping (key -> form) or a sequence (keys are
+    indexes). Invalid forms never match. Filters are evaluated in chunks of
+    `chunk_size` per query to keep SQL size bounded.
+    '''
+    if not hasattr(filterforms, 'items'):
+        filterforms = dict(enumerate(filterforms))
+
+    pk_column = get_pk_column(queryset)
+
+    conditions = []
+    for key, filterform in filterforms.items():
+        if not filterform.is_valid():
+            continue
+        condition = _match_condition(filterform, queryset, pk_column)
+        if condition is not None:
+            conditions.append((key, condition))
+
+    matches = {}
+    for start in range(0, len(conditions), chunk_size):
+        chunk = conditions[start:start + chunk_size]
+        select = SortedDict()
+        select_params = []
+        for i, (key, (sql, params)) in enumerate(chunk):
+            select['datafilters_match_%d' % i] = sql
+            select_params.extend(params)
+
+        rows = queryset.extra(select=select, select_params=select_params)\
+                .values_list('pk', *select.keys())
+        for row in rows:
+            pk, flags = row[0], row[1:]
+            matched = [key for (key, _condition), flag in zip(chunk, flags)
+                       if flag]
+            if matched:
+                matches.setdefault(pk, []).extend(matched)
+
+    return matches
@@ -0,0 +1,373 @@
+'''
+Optional precomputed index for low-cardinality filter specs.
+
+For every choice of an indexable spec (see `FilterSpec.get_index_choices`)
+the index stores a compressed bitmap of primary keys matching the choice's
+lookup. Combinations of indexed specs are then answered by intersecting
+bitmaps, without touching the database::
+
+    poll_index = BitmapIndex('polls', Poll.objects.all(), PollsFilterForm,
+                             dependencies=(Choice,))
+    poll_index.connect()
+
+    ids = poll_index.match(filterform)  # None if index can't answer
+    polls = poll_index.filter(filterform, Poll.objects.all())
+
+Index is built with `rebuild_filter_index` management command and
+maintained incrementally on `post_save` / `post_delete` of the indexed model
+(one query per saved instance; bitmaps are patched under a storage lock, or
+dropped if the lock can't be taken).
+Changes of models listed in `dependencies` (e.g. models spanned by
+lookups) drop the index, so filtering falls back to the database until the
+next rebuild.
+
+Only integer primary keys are supported.
+'''
+import binascii
+import cPickle as pickle
+import fcntl
+import os
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from django.db.models import signals
+from django.utils.datastructures import SortedDict
+
+from datafilters.batch import get_pk_column, in_condition
+from datafilters.cache import get_filter_cache
+from datafilters.filterspec import RuntimeAwareFilterSpecMixin
+from datafilters.utils import spans_multivalued_relation
+
+__all__ = (
+    'BitmapIndex',
+    'CacheIndexStorage',
+    'FileIndexStorage',
+    'registry',
+)
+
+# All constructed indexes by name
+registry = {}
+
+
+def bitmap_from_ids(ids):
+    ids = list(ids)
+    if not ids:
+        return 0
+    buf = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        buf[i >> 3] |= 1 << (i & 7)
+    buf.reverse()
+    return int(binascii.hexlify(bytes(buf)), 16)
+
+
+def ids_from_bitmap(bits):
+    binary = bin(bits)[:1:-1]
+    return [i for i, bit in enumerate(binary) if bit == '1']
+
+
+def encode_bitmap(bits):
+    hexed = '%x' % bits
+    if len(hexed) % 2:
+        hexed = '0' + hexed
+    return zlib.compress(binascii.unhexlify(hexed))
+
+
+def decode_bitmap(data):
+    return int(binascii.hexlify(zlib.decompress(data)), 16)
+
+
+class CacheIndexStorage(object):
+    '''
+    Keep index entries in the datafilters cache (see `datafilters.cache`).
+    '''
+
+    def __init__(self, cache=None, timeout=None, lock_timeout=10):
+        self.cache = cache if cache is not None else get_filter_cache()
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    @contextmanager
+    def lock(self, name):
+        '''
+        Hold lock `name` for a read-modify-write of entries. Yields `False`
+        if it wasn't acquired in `lock_timeout` seconds.
+        '''
+        lock_key = 'datafilters:index-lock:%s' % name
+        deadline = time.time() + self.lock_timeout
+        acquired = self.cache.add(lock_key, 1, self.lock_timeout)
+        while not acquired and time.time() < deadline:
+            time.sleep(0.01)
+            acquired = self.cache.add(lock_key, 1, self.lock_timeout)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.cache.delete(lock_key)
+
+
+class FileIndexStorage(object):
+    '''
+    Keep index entries in a local pickle file.
+
+    File is rewritten atomically on every change and reloaded when modified
+    by another process.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._mutex = threading.Lock()
+        self._entries = {}
+        self._mtime = None
+
+    def _load(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            self._entries, self._mtime = {}, None
+            return
+        if mtime != self._mtime:
+            with open(self.path, 'rb') as f:
+                self._entries = pickle.load(f)
+            self._mtime = mtime
+
+    def _dump(self):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(self._entries, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+        self._mtime = os.path.getmtime(self.path)
+
+    def get(self, key):
+        with self._mutex:
+            self._load()
+            return self._entries.get(key)
+
+    def set(self, key, value):
+        with self._mutex:
+            self._load()
+            self._entries[key] = value
+            self._dump()
+
+    def delete(self, key):
+        with self._mutex:
+            self._load()
+            if self._entries.pop(key, None) is not None:
+                self._dump()
+
+    @contextmanager
+    def lock(self, name):
+        '''
+        Hold an exclusive lock on the file's companion `.lock` file (shared
+        by processes) for a read-modify-write of entries.
+        '''
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class BitmapIndex(object):
+    '''
+    Bitmap index over indexable specs of `filterform_cls` for rows of
+    `queryset`.
+
+    Each entry stores the lookup it was built for, so choices depending on
+    the current date (`DateFieldFilterSpec`) stop matching when the lookup
+    changes, until the index is rebuilt.
+    '''
+
+    def __init__(self, name, queryset, filterform_cls, storage=None,
+            spec_names=None, dependencies=()):
+        self.name = name
+        self.queryset = queryset
+        self.model = queryset.model
+        self.filterform_cls = filterform_cls
+        self.storage = storage if storage is not None else CacheIndexStorage()
+        self.spec_names = spec_names
+        self.dependencies = dependencies
+        registry[name] = self
+
+    def get_indexed_specs(self):
+        specs = []
+        for name, spec in self.filterform_cls.filter_specs_base.items():
+            if self.spec_names is not None and name not in self.spec_names:
+                continue
+            if isinstance(spec, RuntimeAwareFilterSpecMixin):
+                continue
+            if spec.get_index_choices() is not None:
+                specs.append((name, spec))
+        return specs
+
+    def get_key(self, spec_name, choice):
+        return 'datafilters:index:%s:%s:%s' % (self.name, spec_name, choice)
+
+    def iter_entries(self):
+        for name, spec in self.get_indexed_specs():
+            for choice in spec.get_index_choices():
+                yield self.get_key(name, choice), spec, choice
+
+    def rebuild(self):
+        '''
+        Build bitmaps for all choices of indexed specs (one query per
+        choice).
+        '''
+        for key, spec, choice in self.iter_entries():
+            lookup = spec.to_lookup(choice)
+            if not isinstance(lookup, dict) or not lookup:
+                self.storage.delete(key)
+                continue
+            ids = self.queryset.filter(**lookup).values_list('pk', flat=True)
+            self.storage.set(key, {
+                'lookup': lookup,
+                'bitmap': encode_bitmap(bitmap_from_ids(ids)),
+            })
+
+    def invalidate(self):
+        for key, _spec, _choice in self.iter_entries():
+            self.storage.delete(key)
+
+    def match_instance(self, pk, entries):
+        '''
+        Return list of flags: whether row `pk` matches lookups of
+        `entries` (in one query).
+        '''
+        pk_column = get_pk_column(self.queryset)
+        select = SortedDict()
+        select_params = []
+        for i, entry in enumerate(entries):
+            condition = in_condition(self.queryset.filter(**entry['lookup']),
+                                     pk_column, self.queryset.db)
+            if condition is None:
+                condition = ('0', ())
+            select['datafilters_match_%d' % i] = condition[0]
+            select_params.extend(condition[1])
+        rows = self.queryset.filter(pk=pk) \
+            .extra(select=select, select_params=select_params) \
+            .values_list(*select.keys())
+        for row in rows:
+            return [bool(flag) for flag in row]
+        return [False] * len(entries)
+
+    def update_instance(self, instance):
+        keys = [key for key, _spec, _choice in self.iter_entries()]
+        with self.storage.lock(self.name) as locked:
+            if not locked:
+                # Concurrent update would be lost: drop the entries
+                self.invalidate()
+                return
+            entries = [(key, self.storage.get(key)) for key in keys]
+            entries = [(key, entry) for key, entry in entries
+                       if entry is not None]
+            if not entries:
+                return
+            flags = self.match_instance(instance.pk,
+                                        [entry for _key, entry in entries])
+            for (key, entry), matches in zip(entries, flags):
+                bits = decode_bitmap(entry['bitmap'])
+                if matches:
+                    new_bits = bits | (1 << instance.pk)
+                else:
+                    new_bits = bits & ~(1 << instance.pk)
+                if new_bits != bits:
+                    entry['bitmap'] = encode_bitmap(new_bits)
+                    self.storage.set(key, entry)
+
+    def remove_instance(self, instance):
+        with self.storage.lock(self.name) as locked:
+            if not locked:
+                self.invalidate()
+                return
+            for key, _spec, _choice in self.iter_entries():
+                entry = self.storage.get(key)
+                if entry is None:
+                    continue
+                bits = decode_bitmap(entry['bitmap'])
+                if bits & (1 << instance.pk):
+                    entry['bitmap'] = encode_bitmap(bits & ~(1 << instance.pk))
+                    self.storage.set(key, entry)
+
+    def connect(self):
+        '''
+        Subscribe to model signals for incremental maintenance.
+        '''
+        uid = 'datafilters-index-%s' % self.name
+        signals.post_save.connect(self._on_save, sender=self.model,
+                                  weak=False, dispatch_uid=uid)
+        signals.post_delete.connect(self._on_delete, sender=self.model,
+                                    weak=False, dispatch_uid=uid)
+        for model in self.dependencies:
+            signals.post_save.connect(self._on_dependency_change,
+                                      sender=model, weak=False,
+                                      dispatch_uid=uid)
+            signals.post_delete.connect(self._on_dependency_change,
+                                        sender=model, weak=False,
+                                        dispatch_uid=uid)
+
+    def _on_save(self, sender, instance, **kwargs):
+        self.update_instance(instance)
+
+    def _on_delete(self, sender, instance, **kwargs):
+        self.remove_instance(instance)
+
+    def _on_dependency_change(self, sender, **kwargs):
+        self.invalidate()
+
+    def match(self, filterform):
+        '''
+        Return list of primary keys matching the filter form, or `None` if
+        the index can't answer (form is invalid or empty, some active spec
+        is not indexed, or index entry is missing or stale).
+        '''
+        if not filterform.is_valid():
+            return None
+
+        indexed = dict(self.get_indexed_specs())
+        bits = None
+        multivalued_specs = 0
+        for name, (value, lookup) in filterform.active_specs.items():
+            if name not in indexed:
+                return None
+            entry = self.storage.get(self.get_key(name, value))
+            if entry is None or entry['lookup'] != lookup:
+                return None
+            for lookup_key in lookup:
+                if spans_multivalued_relation(self.model, lookup_key):
+                    multivalued_specs += 1
+                    break
+            entry_bits = decode_bitmap(entry['bitmap'])
+            bits = entry_bits if bits is None else bits & entry_bits
+
+        if bits is None:
+            return None
+
+        # Bitmaps are intersected spec by spec, which is only equivalent to
+        # a single `filter` call when specs don't share multi-valued joins
+        if not filterform.use_filter_chaining and multivalued_specs > 1:
+            return None
+
+        return ids_from_bitmap(bits)
+
+    def filter(self, filterform, queryset):
+        '''
+        Filter queryset using the index if possible, with `filterform` as a
+        fallback.
+        '''
+        ids = self.match(filterform)
+        if ids is None:
+            return filterform.filter(queryset)
+        return queryset.filter(pk__in=ids)
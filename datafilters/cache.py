@@ -0,0 +1,163 @@
+'''
+Access to the cache backend used by datafilters.
+
+The backend is selected with `DATAFILTERS_CACHE` setting (an alias from
+`CACHES`, 'default' if not set).
+'''
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models import signals
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.encoding import smart_str
+
+__all__ = (
+    'bump_model_version',
+    'bump_version',
+    'describe_aggregates',
+    'describe_queryset',
+    'get_filter_cache',
+    'get_form_data',
+    'get_model_version',
+    'get_version',
+    'make_key',
+    'track_model_version',
+)
+
+_caches = {}
+
+
+def get_filter_cache():
+    '''
+    Return cache backend instance configured for datafilters.
+    '''
+    alias = getattr(settings, 'DATAFILTERS_CACHE', 'default')
+    if alias not in _caches:
+        _caches[alias] = get_cache(alias)
+    return _caches[alias]
+
+
+def make_key(prefix, *parts):
+    '''
+    Build a cache key from `prefix` and a hash of arbitrary `parts`.
+    '''
+    digest = hashlib.md5(smart_str(repr(parts))).hexdigest()
+    return 'datafilters:%s:%s' % (prefix, digest)
+
+
+def describe_queryset(queryset):
+    '''
+    Return hashable description of the query: database alias, SQL and
+    parameters. Querysets with equal descriptions return equal results.
+    '''
+    compiler = queryset.query.get_compiler(using=queryset.db)
+    try:
+        sql, params = compiler.as_sql()
+    except EmptyResultSet:
+        sql, params = None, ()
+    return (queryset.db, sql, tuple(params))
+
+
+def describe_aggregates(aggregate_args):
+    '''
+    Return stable description of `QuerySet.aggregate` keyword arguments.
+    '''
+    return tuple(sorted(
+        (alias, aggregate.name, aggregate.lookup,
+         tuple(sorted(aggregate.extra.items())))
+        for alias, aggregate in aggregate_args.items()))
+
+
+def get_form_data(form):
+    '''
+    Return normalized data of the form: sorted tuple of (field name, value)
+    pairs with empty values omitted. Unbound forms are described by their
+    initial values.
+
+    Two forms with equal normalized data produce the same lookups, so it is
+    a safe part of a cache key. Parameters not related to form fields
+    (e.g. page number) are not included.
+    '''
+    items = []
+    for name, field in form.fields.items():
+        if form.is_bound:
+            value = field.widget.value_from_datadict(
+                form.data, form.files, form.add_prefix(name))
+        else:
+            value = form.initial.get(name, field.initial)
+            if callable(value):
+                value = value()
+        if value in (None, '', [], ()):
+            continue
+        if isinstance(value, list):
+            value = tuple(value)
+        items.append((name, value))
+    items.sort()
+    return tuple(items)
+
+
+def _get_version_key(model):
+    opts = model._meta
+    return 'datafilters:version:%s.%s' % (opts.app_label, opts.object_name)
+
+
+def _initial_version():
+    # Versions are never reused after a cache eviction
+    return int(time.time() * 1000)
+
+
+def get_version(key):
+    '''
+    Return current value of version counter stored under `key`.
+    '''
+    cache = get_filter_cache()
+    version = cache.get(key)
+    if version is None:
+        version = _initial_version()
+        if not cache.add(key, version):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_version(key):
+    '''
+    Increment version counter stored under `key` and return its new value.
+    '''
+    cache = get_filter_cache()
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = _initial_version()
+        cache.set(key, version)
+        return version
+
+
+def get_model_version(model):
+    '''
+    Return a number that changes each time an instance of `model` is saved
+    or deleted (see `track_model_version`).
+
+    Use it as a part of cache keys for data derived from the model.
+    '''
+    return get_version(_get_version_key(model))
+
+
+def bump_model_version(model):
+    bump_version(_get_version_key(model))
+
+
+def _bump_sender_version(sender, **kwargs):
+    bump_model_version(sender)
+
+
+def track_model_version(model):
+    '''
+    Bump version of `model` on its `post_save` and `post_delete` signals.
+    '''
+    uid = 'datafilters-version-%s' % _get_version_key(model)
+    signals.post_save.connect(_bump_sender_version, sender=model,
+                              dispatch_uid=uid)
+    signals.post_delete.connect(_bump_sender_version, sender=model,
+                                dispatch_uid=uid)
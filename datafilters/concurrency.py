@@ -0,0 +1,196 @@
+'''
+Running independent read queries on separate database connections.
+
+Django connections are per thread, so queries run by `run_concurrently`
+use their own connections, which are closed when the worker is done::
+
+    count, page = run_concurrently([queryset.count, lambda: list(page_qs)],
+                                   timeout=2)
+
+Concurrent queries don't see uncommitted changes of the calling thread's
+transaction, so use it only for reads.
+'''
+import logging
+import Queue
+import threading
+import time
+
+from django.db import DatabaseError, connections
+
+__all__ = (
+    'ConcurrencyTimeout',
+    'can_run_concurrently',
+    'prefetch_iterators',
+    'run_concurrently',
+    'run_queries',
+    'run_sequentially',
+)
+
+logger = logging.getLogger('datafilters')
+
+# End of items of a prefetched iterator
+_DONE = object()
+
+
+class ConcurrencyTimeout(Exception):
+    pass
+
+
+def can_run_concurrently(using):
+    '''
+    Return `False` if other connections can't see the data of `using`
+    database (in-memory SQLite).
+    '''
+    connection = connections[using]
+    return not (connection.vendor == 'sqlite' and
+                connection.settings_dict['NAME'] in ('', ':memory:'))
+
+
+def run_sequentially(funcs):
+    return [func() for func in funcs]
+
+
+def _run_threads(funcs, max_workers, timeout):
+    '''
+    Call `funcs` on at most `max_workers` threads and return lists of their
+    results and exceptions in order.
+    '''
+    results = [None] * len(funcs)
+    errors = [None] * len(funcs)
+    pending = iter(range(len(funcs)))
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    index = next(pending, None)
+                if index is None:
+                    return
+                try:
+                    results[index] = funcs[index]()
+                except Exception as e:
+                    errors[index] = e
+        finally:
+            # Connections opened by this thread are not reused
+            for connection in connections.all():
+                connection.close()
+
+    threads = []
+    for i in range(min(max_workers, len(funcs))):
+        thread = threading.Thread(target=worker,
+                                  name='datafilters-worker-%d' % i)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    deadline = None if timeout is None else time.time() + timeout
+    for thread in threads:
+        if deadline is None:
+            thread.join()
+        else:
+            thread.join(max(deadline - time.time(), 0))
+        if thread.is_alive():
+            raise ConcurrencyTimeout('Concurrent queries took longer '
+                                     'than %s seconds' % timeout)
+    return results, errors
+
+
+def run_concurrently(funcs, max_workers=4, timeout=None):
+    '''
+    Call `funcs` on at most `max_workers` threads and return list of their
+    results in order.
+
+    The first exception raised by a function is re-raised in the caller.
+    `ConcurrencyTimeout` is raised if results are not ready in `timeout`
+    seconds (unfinished workers are left to complete in background).
+    '''
+    funcs = list(funcs)
+    if len(funcs) < 2 or max_workers < 2:
+        return run_sequentially(funcs)
+
+    results, errors = _run_threads(funcs, max_workers, timeout)
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
+
+
+def run_queries(funcs, databases, max_workers=4, timeout=None):
+    '''
+    Run `funcs` querying `databases` concurrently if possible (or one after
+    another if databases can't be shared between connections).
+
+    Functions failing with database errors on their threads are called
+    again in the caller's thread. `ConcurrencyTimeout` is raised, without
+    running unfinished queries again, if results are not ready in `timeout`
+    seconds.
+    '''
+    funcs = list(funcs)
+    if (len(funcs) < 2 or not max_workers or max_workers < 2 or
+            not all(can_run_concurrently(using) for using in databases)):
+        return run_sequentially(funcs)
+
+    results, errors = _run_threads(funcs, max_workers, timeout)
+    for index, error in enumerate(errors):
+        if error is None:
+            continue
+        if not isinstance(error, DatabaseError):
+            raise error
+        logger.warning('Repeating failed query in the caller: %s', error)
+        results[index] = funcs[index]()
+    return results
+
+
+def _prefetch(func, queue, stop):
+    def put(item, error=None):
+        while not stop.is_set():
+            try:
+                queue.put((item, error), timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    try:
+        for item in func():
+            if not put(item):
+                return
+        put(_DONE)
+    except Exception as e:
+        put(_DONE, e)
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+
+def _consume(queue, stop):
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        # Let the thread finish if the iterator is abandoned
+        stop.set()
+
+
+def prefetch_iterators(funcs, prefetch=100):
+    '''
+    Start iterators returned by `funcs` on separate threads, reading at
+    most `prefetch` items ahead, and return list of iterators over their
+    items. Errors of threads are raised by the returned iterators.
+    '''
+    iterators = []
+    for i, func in enumerate(funcs):
+        queue = Queue.Queue(prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=_prefetch, args=(func, queue, stop),
+                                  name='datafilters-prefetch-%d' % i)
+        thread.daemon = True
+        thread.start()
+        iterators.append(_consume(queue, stop))
+    return iterators
@@ -1,10 +1,63 @@
+import cPickle as pickle
 from functools import wraps
 
+from datafilters.cache import describe_aggregates, describe_queryset, \
+    make_key
+from datafilters.concurrency import ConcurrencyTimeout, run_queries, \
+    run_sequentially
+from datafilters.guard import QueryTimeout
+from datafilters.routing import ReplicaFallback, route_queryset
+from datafilters.singleflight import SingleFlight
+
 __all__ = ('filter_powered',)
 
+# Used with `coalesce=True`
+default_flight = SingleFlight()
+
 
 def filter_powered(filterform_cls, queryset_name='object_list', pass_params=False,
-        add_count=False, aggregate_args={}, values_spec=None, deferred=None):
+        add_count=False, aggregate_args={}, values_spec=None, deferred=None,
+        read_database=None, replication_lag=None, coalesce=None,
+        aggregate_cache=None, concurrent=False, concurrency_timeout=None,
+        refinement_cache=None, page_size=None, result_cache=None):
+    '''
+    Decorator to filter a queryset in the view's context with
+    `filterform_cls`.
+
+    With `page_size` the queryset in the context is sliced to the page of
+    objects requested with the `page` parameter.
+
+    With `coalesce` (`True` or a single flight group from
+    `datafilters.singleflight`) concurrent requests with identical filtered
+    queries share one evaluation of count and aggregates, and of objects if
+    `page_size` is set. Each request gets its own copies of shared objects.
+
+    Aggregates are taken from `aggregate_cache`
+    (`datafilters.aggregates.AggregateCache`), if given.
+
+    With `concurrent` (`True` or a maximum number of threads) count,
+    aggregates and the page of objects (if `page_size` is set) are fetched
+    in parallel on separate connections, or one after another if the
+    database can't be shared between connections. If they are not ready in
+    `concurrency_timeout` seconds, the form gets an error and the object
+    list is empty (as with `statement_timeout` of the form).
+
+    Reads failing on `read_database` are repeated on the primary database
+    (see `datafilters.routing.ReplicaFallback`); objects read from a replica
+    are fetched by the decorator.
+
+    With `refinement_cache` (`datafilters.refinement.RefinementCache`)
+    results of recent filters of the user are reused when the filter is
+    narrowed down.
+
+    With `result_cache` (`datafilters.results.FilterResultCache`) count,
+    aggregates (unless `aggregate_cache` is given) and the page of objects
+    are cached, so they can also be warmed in advance.
+    '''
+    if coalesce is True:
+        coalesce = default_flight
+    if concurrent is True:
+        concurrent = 3
 
     def decorator(view):
 
@@ -27,16 +80,111 @@ def filter_powered(filterform_cls, queryset_name='object_list', pass_params=Fals
             filterform = filterform_cls(request.GET,
                                         runtime_context=kwargs)
 
+            fallback = ReplicaFallback(queryset.db)
+            queryset = route_queryset(
+                request, queryset,
+                read_database or filterform.read_database, replication_lag)
             # Perform actual filtering
-            queryset = filterform.filter(queryset).distinct()
+            if refinement_cache is not None and filterform.is_valid():
+                queryset = fallback.read(
+                    lambda qs: refinement_cache.filter(request, filterform,
+                                                       qs),
+                    queryset)
+            else:
+                queryset = filterform.filter(queryset).distinct()
+
+            count_name = queryset_name + '_count'
+            if values_spec:
+                object_list = queryset.values(*values_spec)
+            else:
+                object_list = filterform.apply_query_hints(queryset)
+            if page_size is not None:
+                try:
+                    page = max(int(request.GET.get('page', 1)), 1)
+                except ValueError:
+                    page = 1
+                object_list = object_list[(page - 1) * page_size:
+                                          page * page_size]
+
+            def count(queryset):
+                if result_cache is not None:
+                    return {count_name: result_cache.count(queryset)}
+                return {count_name: queryset.count()}
+
+            def aggregate(queryset):
+                if aggregate_cache is not None:
+                    return aggregate_cache.aggregate(queryset, aggregate_args)
+                if result_cache is not None:
+                    return result_cache.aggregate(queryset, aggregate_args)
+                return queryset.aggregate(**aggregate_args)
+
+            def fetch(object_list):
+                if result_cache is not None:
+                    return {queryset_name: result_cache.page(object_list)}
+                return {queryset_name: list(object_list)}
+
+            def read(func, queryset):
+                # Timeouts are raised as QueryTimeout by the guard, so only
+                # failures of the replica are retried
+                def guarded(queryset):
+                    with filterform.query_guard(queryset.db):
+                        return func(queryset)
+                return lambda: fallback.read(guarded, queryset)
 
+            tasks = []
             if add_count:
-                context[queryset_name + '_count'] = queryset.count()
+                tasks.append(read(count, queryset))
             if aggregate_args:
-                aggregated = queryset.aggregate(**aggregate_args)
-                context.update(aggregated)
-            if values_spec:
-                queryset = queryset.values(*values_spec)
+                tasks.append(read(aggregate, queryset))
+            # A page of objects can be fetched along with other queries.
+            # Other object lists are left lazy, unless they must be read
+            # under the timeout or from a replica, which may fail
+            if (page_size is not None and (
+                    coalesce is not None or concurrent or
+                    result_cache is not None) or
+                    filterform.statement_timeout is not None or
+                    object_list.db != fallback.primary):
+                tasks.append(read(fetch, object_list))
+
+            def evaluate():
+                if concurrent:
+                    results = run_queries(tasks, [queryset.db], concurrent,
+                                          concurrency_timeout)
+                else:
+                    results = run_sequentially(tasks)
+                joined = {}
+                for result in results:
+                    joined.update(result)
+                return joined
+
+            try:
+                if coalesce is None:
+                    results = evaluate()
+                else:
+                    # Results are shared under names of the queryset
+                    key = make_key('flight', queryset_name,
+                                   describe_queryset(object_list),
+                                   add_count,
+                                   describe_aggregates(aggregate_args))
+                    results = coalesce.do(key, evaluate)
+            except (QueryTimeout, ConcurrencyTimeout):
+                filterform.handle_timeout()
+                object_list = object_list.none()
+                results = {count_name: 0} if add_count else {}
+
+            # Results may be shared with concurrent requests
+            results = dict(results)
+            rows = results.pop(queryset_name, None)
+            queryset = fallback.using(object_list)
+            if rows is not None:
+                if coalesce is not None:
+                    # Unlike deepcopy, pickling keeps prefetched objects
+                    rows = pickle.loads(pickle.dumps(rows, -1))
+                queryset = queryset._clone()
+                queryset._result_cache = rows
+                queryset._prefetch_done = True
+            context.update(results)
+
             if deferred is not None:
                 queryset, context = deferred(queryset, context)
 
@@ -1,23 +1,148 @@
+from django.db.models.sql.constants import LOOKUP_SEP
+from django.db.models.sql.where import AND
+
+__all__ = ('Condition', 'Extra')
+
+
+class ColumnWhere(object):
+    '''
+    Where node child rendering `sql` with `{column}` replaced by the quoted
+    column of a joined table.
+    '''
+
+    def __init__(self, alias, column, sql, params):
+        self.alias = alias
+        self.column = column
+        self.sql = sql
+        self.params = params
+
+    def as_sql(self, qn=None, connection=None):
+        column = '%s.%s' % (qn(self.alias), qn(self.column))
+        return self.sql.replace('{column}', column), tuple(self.params)
+
+    def relabel_aliases(self, change_map):
+        if self.alias in change_map:
+            self.alias = change_map[self.alias]
+
+
+class Condition(object):
+    '''
+    SQL condition on a model field, compiled by the query compiler (joins
+    and table aliases are set up as for an ordinary lookup)::
+
+        Condition('choice__votes', '{column} %% 2 = %s', [0])
+
+    Unlike `where` strings of `Extra`, it doesn't depend on table names.
+    '''
+
+    def __init__(self, field_name, sql, params=()):
+        self.field_name = field_name
+        self.sql = sql
+        self.params = tuple(params)
+
+    def __eq__(self, other):
+        return (isinstance(other, Condition) and
+                (self.field_name, self.sql, self.params) ==
+                (other.field_name, other.sql, other.params))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def add_to_query(self, query):
+        opts = query.get_meta()
+        names = self.field_name.split(LOOKUP_SEP)
+        field, target, opts, joins, last, extra = query.setup_joins(
+            names, opts, query.get_initial_alias(), False)
+        query.where.add(ColumnWhere(joins[-1], target.column,
+                                    self.sql, self.params), AND)
+
+
 class Extra(object):
+    '''
+    Conditions to apply with `QuerySet.extra` (`where` with bound `params`,
+    `tables`) and compiled `Condition` objects.
+
+    Merged `Extra` objects don't repeat identical clauses and tables, so
+    specs sharing them don't produce extra cross joins.
+    '''
 
-    def __init__(self, where=None, tables=None):
-        self.where = where if where is not None else []
-        self.tables = tables if tables is not None else []
+    def __init__(self, where=None, tables=None, params=None, conditions=None):
+        self.where = []
+        self.params = []
+        # (where clauses, their params) pairs merged so far
+        self._where_groups = []
+        if where:
+            self.add_where_group((tuple(where), tuple(params or ())))
+        self.tables = []
+        self.conditions = []
+        self.add_tables(tables or ())
+        self.add_conditions(conditions or ())
+
+    @property
+    def where_groups(self):
+        '''
+        List of (where clauses, their params) pairs. Clauses added to
+        `where` and `params` directly make a group of their own.
+        '''
+        groups = list(self._where_groups)
+        clauses = [c for group_clauses, _p in groups for c in group_clauses]
+        params = [p for _c, group_params in groups for p in group_params]
+        if (self.where[:len(clauses)] != clauses or
+                self.params[:len(params)] != params):
+            # `where` or `params` were replaced
+            groups = []
+            clauses, params = [], []
+        if len(self.where) > len(clauses) or len(self.params) > len(params):
+            groups.append((tuple(self.where[len(clauses):]),
+                           tuple(self.params[len(params):])))
+        return groups
+
+    def add_where_group(self, group):
+        self._where_groups.append(group)
+        self.where.extend(group[0])
+        self.params.extend(group[1])
+
+    def add_tables(self, tables):
+        for table in tables:
+            if table not in self.tables:
+                self.tables.append(table)
+
+    def add_conditions(self, conditions):
+        for condition in conditions:
+            if condition not in self.conditions:
+                self.conditions.append(condition)
 
     def is_empty(self):
-        return self.where or self.tables
+        return bool(self.where or self.tables or self.conditions)
 
     def add(self, extra):
-        self.where.extend(extra.where)
-        self.tables.extend(extra.tables)
+        self._where_groups = self.where_groups
+        for group in extra.where_groups:
+            if group not in self._where_groups:
+                self.add_where_group(group)
+        self.add_tables(extra.tables)
+        self.add_conditions(extra.conditions)
         return self
 
     def as_kwargs(self):
         return {
             'where': self.where,
             'tables': self.tables,
+            'params': self.params,
         }
 
+    def apply(self, queryset):
+        '''
+        Return queryset with all conditions applied.
+        '''
+        if self.where or self.tables:
+            queryset = queryset.extra(**self.as_kwargs())
+        if self.conditions:
+            queryset = queryset.all()
+            for condition in self.conditions:
+                condition.add_to_query(queryset.query)
+        return queryset
+
     # little magic
     __iadd__ = add
     __bool__ = __nonzero__ = is_empty
@@ -0,0 +1,151 @@
+'''
+Form-less parsing of filter parameters.
+
+`FilterParser` turns request data into lookups using the specs of a filter
+form class, without building forms, bound fields and widgets for every
+request. Useful for API endpoints that don't render filter forms::
+
+    parser = FilterParser(PollsFilterForm)
+
+    def poll_list(request):
+        parsed = parser.parse(request.GET)
+        if not parsed.is_valid():
+            return json_response({'errors': parsed.errors}, status=400)
+        polls = parsed.filter(Poll.objects.all())
+
+Lookups are the same as produced by the form, including the `max_cost`
+check. Hooks of the form itself (`clean_<field>` methods, custom `clean`)
+are not run, so forms defining them are not supported.
+'''
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.forms.forms import NON_FIELD_ERRORS
+from django.forms.widgets import FileInput
+from django.utils.datastructures import SortedDict
+from django.utils.encoding import force_unicode
+
+from datafilters.filterform import FilterFormBase, apply_lookups, \
+    collect_lookups, join_dicts
+
+__all__ = ('FilterParser', 'ParsedFilter')
+
+
+class ParsedFilter(object):
+    '''
+    Result of `FilterParser.parse`: lookups and errors.
+
+    `errors` maps parameter names (and `NON_FIELD_ERRORS`) to lists of
+    messages.
+    '''
+
+    def __init__(self, use_filter_chaining=False):
+        self.use_filter_chaining = use_filter_chaining
+        self.errors = {}
+        self.simple_lookups = []
+        self.complex_conditions = []
+        self.extra_conditions = None
+        self.active_specs = SortedDict()
+        self.total_cost = 0
+        self.over_budget = False
+
+    def is_valid(self):
+        return not self.errors
+
+    def get_lookup_args(self):
+        '''
+        Return `(Q list, kwargs)` for `QuerySet.filter` (see
+        `FilterFormBase.get_lookup_args`).
+        '''
+        if self.is_valid():
+            return self.complex_conditions, join_dicts(self.simple_lookups)
+        else:
+            return (), {}
+
+    def get_extra_conditions(self):
+        if self.is_valid():
+            return self.extra_conditions
+        else:
+            return None
+
+    def filter(self, queryset):
+        if self.over_budget:
+            return queryset.none()
+        if not self.is_valid():
+            return queryset
+        return apply_lookups(queryset, self.simple_lookups,
+                             self.complex_conditions, self.extra_conditions,
+                             self.use_filter_chaining)
+
+
+class FilterParser(object):
+    '''
+    Parser of request data for `filterform_cls`.
+
+    Form fields of the specs are built once and used only to read
+    (`value_from_datadict`) and coerce (`clean`) raw values.
+    '''
+
+    def __init__(self, filterform_cls, prefix=None, use_filter_chaining=None):
+        if not issubclass(filterform_cls, FilterFormBase):
+            raise ImproperlyConfigured('%s is not a filter form'
+                                       % filterform_cls.__name__)
+        if filterform_cls.clean.im_func is not FilterFormBase.clean.im_func:
+            raise ImproperlyConfigured('%s.clean is not supported by '
+                                       'FilterParser'
+                                       % filterform_cls.__name__)
+        self.filterform_cls = filterform_cls
+        self.prefix = prefix
+        if use_filter_chaining is None:
+            use_filter_chaining = filterform_cls.use_filter_chaining
+        self.use_filter_chaining = use_filter_chaining
+
+        filter_specs = getattr(filterform_cls, 'filter_specs', None)
+        if isinstance(filter_specs, tuple):
+            filter_specs = dict((fs.field_name, fs) for fs in filter_specs)
+        else:
+            filter_specs = filterform_cls.filter_specs_base
+        self.filter_specs = filter_specs
+
+        self.coercers = []
+        for name, spec in filter_specs.iteritems():
+            if hasattr(filterform_cls, 'clean_%s' % name):
+                raise ImproperlyConfigured(
+                    '%s.clean_%s is not supported by FilterParser'
+                    % (filterform_cls.__name__, name))
+            field = filterform_cls.make_field(spec)
+            if isinstance(field.widget, FileInput):
+                raise ImproperlyConfigured('File fields are not supported '
+                                           'by FilterParser')
+            self.coercers.append((name, self.add_prefix(name),
+                                  field.widget.value_from_datadict,
+                                  field.clean))
+
+    def add_prefix(self, name):
+        return self.prefix and ('%s-%s' % (self.prefix, name)) or name
+
+    def parse(self, data, runtime_context=None):
+        '''
+        Parse `data` (a `QueryDict` or a plain dict) into `ParsedFilter`.
+        '''
+        result = ParsedFilter(self.use_filter_chaining)
+        cleaned_data = {}
+        for name, key, value_from_datadict, clean in self.coercers:
+            value = value_from_datadict(data, None, key)
+            try:
+                cleaned_data[name] = clean(value)
+            except ValidationError as e:
+                result.errors[name] = [force_unicode(m) for m in e.messages]
+        if result.errors:
+            return result
+
+        (result.simple_lookups, result.complex_conditions,
+         result.extra_conditions, result.active_specs) = collect_lookups(
+            self.filter_specs, cleaned_data, runtime_context or {})
+
+        result.total_cost = sum(self.filter_specs[name].cost
+                                for name in result.active_specs)
+        max_cost = self.filterform_cls.max_cost
+        if max_cost is not None and result.total_cost > max_cost:
+            result.over_budget = True
+            message = self.filterform_cls.error_messages['too_expensive']
+            result.errors[NON_FIELD_ERRORS] = [force_unicode(message)]
+        return result
@@ -0,0 +1,147 @@
+'''
+Form fields used by builtin filter specs.
+'''
+import hashlib
+
+from django import forms
+from django.core import validators
+from django.core.exceptions import ValidationError
+from django.utils.encoding import smart_str
+from django.utils.translation import ugettext_lazy as _
+
+from datafilters.cache import get_filter_cache, get_model_version
+
+__all__ = ('CachedModelChoiceField', 'LazyModelChoices', 'RangeField')
+
+
+class LazyModelChoices(object):
+    '''
+    Re-iterable choices built from a queryset.
+
+    Nothing is loaded until the first iteration. Then the list of
+    (pk, label) pairs is taken from the cache, or built from the queryset
+    and cached for `timeout` seconds. Cache key includes version of the
+    queryset's model, so cached choices are dropped on its changes (see
+    `datafilters.cache.track_model_version`).
+    '''
+
+    def __init__(self, queryset, label_from_instance=None,
+            empty_label=u'---------', timeout=None):
+        self.queryset = queryset
+        self.label_from_instance = label_from_instance or unicode
+        self.empty_label = empty_label
+        self.timeout = timeout
+        self._choices = None
+
+    def get_cache_key(self):
+        model = self.queryset.model
+        query_hash = hashlib.md5(smart_str(self.queryset.query)).hexdigest()
+        return 'datafilters:choices:%s.%s:%s:%s' % (
+            model._meta.app_label, model._meta.object_name,
+            get_model_version(model), query_hash)
+
+    def load(self):
+        cache = get_filter_cache()
+        key = self.get_cache_key()
+        choices = cache.get(key)
+        if choices is None:
+            choices = [(obj.pk, self.label_from_instance(obj))
+                       for obj in self.queryset.all()]
+            cache.set(key, choices, self.timeout)
+        return choices
+
+    def __iter__(self):
+        if self._choices is None:
+            self._choices = self.load()
+        if self.empty_label is not None:
+            yield (u'', self.empty_label)
+        for choice in self._choices:
+            yield choice
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+class CachedModelChoiceField(forms.ChoiceField):
+    '''
+    Choice field with lazy, cached choices from a queryset.
+
+    Cleaned value is a primary key converted with `coerce`. Unless
+    `validate_choice` is set, value is not checked against the choices, so
+    they are not loaded at all if the form is not rendered.
+    '''
+
+    def __init__(self, queryset, label_from_instance=None,
+            empty_label=u'---------', timeout=None, coerce=int,
+            validate_choice=False, *args, **kwargs):
+        self.coerce = coerce
+        self.validate_choice = validate_choice
+        kwargs['choices'] = LazyModelChoices(queryset,
+                label_from_instance=label_from_instance,
+                empty_label=empty_label, timeout=timeout)
+        super(CachedModelChoiceField, self).__init__(*args, **kwargs)
+
+    def _set_choices(self, value):
+        # Unlike ChoiceField, don't evaluate choices here
+        self._choices = self.widget.choices = value
+
+    choices = property(forms.ChoiceField._get_choices, _set_choices)
+
+    def validate(self, value):
+        if self.validate_choice:
+            super(CachedModelChoiceField, self).validate(value)
+        else:
+            forms.Field.validate(self, value)
+
+    def clean(self, value):
+        value = super(CachedModelChoiceField, self).clean(value)
+        if value in validators.EMPTY_VALUES:
+            return None
+        try:
+            return self.coerce(value)
+        except (ValueError, TypeError):
+            raise ValidationError(
+                self.error_messages['invalid_choice'] % {'value': value})
+
+
+class RangeWidget(forms.MultiWidget):
+
+    def __init__(self, attrs=None):
+        widgets = (forms.TextInput(attrs=attrs), forms.TextInput(attrs=attrs))
+        super(RangeWidget, self).__init__(widgets, attrs)
+
+    def decompress(self, value):
+        if value:
+            return list(value)
+        return [None, None]
+
+
+class RangeField(forms.MultiValueField):
+    '''
+    Pair of optional bounds (minimum, maximum), each cleaned by a field of
+    `base_field` class. Cleaned value is a (minimum, maximum) tuple with
+    `None` for a missing bound, or `None` if both are missing.
+    '''
+
+    widget = RangeWidget
+    default_error_messages = {
+        'invalid_range': _('Minimum must be less than maximum.'),
+    }
+
+    def __init__(self, base_field=forms.DecimalField, *args, **kwargs):
+        fields = (base_field(required=False), base_field(required=False))
+        super(RangeField, self).__init__(fields, *args, **kwargs)
+
+    def compress(self, data_list):
+        if not data_list:
+            return None
+        minimum, maximum = data_list
+        if minimum in validators.EMPTY_VALUES:
+            minimum = None
+        if maximum in validators.EMPTY_VALUES:
+            maximum = None
+        if minimum is None and maximum is None:
+            return None
+        if minimum is not None and maximum is not None and minimum >= maximum:
+            raise ValidationError(self.error_messages['invalid_range'])
+        return (minimum, maximum)
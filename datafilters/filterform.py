@@ -1,10 +1,15 @@
 from django import forms
 from copy import deepcopy
 from django.db.models import Q
+from django.forms.forms import NON_FIELD_ERRORS
+from django.utils.datastructures import SortedDict
+from django.utils.translation import ugettext_lazy as _
 
 from datafilters.filterspec import FilterSpec, RuntimeAwareFilterSpecMixin
 from datafilters.declarative import declarative_fields
 from datafilters.extra_lookup import Extra
+from datafilters.guard import estimate_rows, statement_timeout
+from datafilters.sharding import ShardedQuerySet
 
 __all__ = ('FilterForm', 'ChainingFilterForm', 'FilterFormBase')
 
@@ -16,6 +21,63 @@ def join_dicts(dicts):
     return result
 
 
+def collect_lookups(filter_specs, cleaned_data, runtime_context):
+    '''
+    Convert cleaned values of `filter_specs` to lookups.
+
+    :return:
+        Tuple of simple lookups (list of mappings), complex conditions
+        (list of `Q` objects), merged `Extra` conditions and active specs
+        (spec name -> (cleaned value, lookup)).
+    '''
+    simple_lookups = []
+    complex_conditions = []
+    extra_conditions = Extra()
+    active_specs = SortedDict()
+    for name, spec in filter_specs.iteritems():
+        raw_value = cleaned_data.get(name)
+        if isinstance(spec, RuntimeAwareFilterSpecMixin):
+            lookup_or_condition = spec.to_lookup(raw_value, runtime_context=runtime_context)
+        else:
+            lookup_or_condition = spec.to_lookup(raw_value)
+
+        if lookup_or_condition:
+            active_specs[name] = (raw_value, lookup_or_condition)
+
+        if isinstance(lookup_or_condition, Q) and lookup_or_condition:
+                complex_conditions.append(lookup_or_condition)
+        elif isinstance(lookup_or_condition, Extra):
+            extra_conditions += lookup_or_condition
+        elif lookup_or_condition:
+            simple_lookups.append(lookup_or_condition)
+
+    return simple_lookups, complex_conditions, extra_conditions, active_specs
+
+
+def apply_lookups(queryset, simple_lookups, complex_conditions,
+        extra_conditions, use_filter_chaining=False):
+    '''
+    Return `queryset` filtered with lookups collected by `collect_lookups`,
+    in one `filter` call or one call per lookup (`use_filter_chaining`).
+    '''
+    if extra_conditions:
+        queryset = extra_conditions.apply(queryset)
+
+    if not use_filter_chaining:
+        lookup = join_dicts(simple_lookups)
+        return queryset.filter(*complex_conditions, **lookup)
+
+    for lookup in simple_lookups:
+        if lookup:
+            queryset = queryset.filter(**lookup)
+
+    for query in complex_conditions:
+        if query:
+            queryset = queryset.filter(query)
+
+    return queryset
+
+
 class FilterFormBase(forms.Form):
 
     __metaclass__ = declarative_fields(FilterSpec, type(forms.Form),
@@ -24,15 +86,50 @@ class FilterFormBase(forms.Form):
     default_fields_args = {'required': False}
     fields_per_column = 4
     use_filter_chaining = False
+    # Database alias to read filtered data from (see `datafilters.routing`)
+    read_database = None
+
+    # Cost policy: maximum total `cost` of active specs, maximum number of
+    # rows estimated by the query planner and timeout (in milliseconds) for
+    # evaluation of filtered queries (see `query_guard`)
+    max_cost = None
+    max_estimated_rows = None
+    statement_timeout = None
+
+    # Query hints always applied to filtered querysets (see
+    # `get_query_hints`)
+    select_related = ()
+    prefetch_related = ()
+    only = ()
+
+    # `datafilters.analytics.FilterStatsCollector` recording usage and
+    # latency of spec combinations
+    stats_collector = None
+
+    # Database aliases of shards to filter with `filter_sharded`
+    shard_databases = ()
+
+    error_messages = {
+        'too_expensive': _('This combination of filters is too expensive. '
+                           'Please narrow down your search.'),
+        'timeout': _('Filtering took too long. '
+                     'Please narrow down your search.'),
+    }
 
     def __init__(self, data=None, **kwargs):
         self.simple_lookups = []
         self.complex_conditions = []
         self.extra_conditions = Extra()
+        self.active_specs = SortedDict()
+        self.total_cost = 0
+        # Set when the cost policy rejects the filter: filtering gives no
+        # objects instead of all of them
+        self.over_budget = False
 
         use_filter_chaining = kwargs.pop('use_filter_chaining', None)
         if use_filter_chaining is None:
             use_filter_chaining = self.use_filter_chaining
+        self.use_filter_chaining = use_filter_chaining
 
         self.filter = self.filter_chaining \
             if use_filter_chaining else self.filter_bulk
@@ -50,16 +147,22 @@ class FilterFormBase(forms.Form):
 
         # Generate form fields
         for name, spec in self.filter_specs.iteritems():
-            if isinstance(spec.filter_field, forms.Field):
-                self.fields[name] = spec.filter_field
-            else:
-                field_cls, local_field_kwargs = spec.filter_field
-                field_kwargs = self.default_fields_args.copy()
-                field_kwargs.update(local_field_kwargs)
-                self.fields[name] = field_cls(**field_kwargs)
+            self.fields[name] = self.make_field(spec)
 
         self.spec_count = len(self.filter_specs)
 
+    @classmethod
+    def make_field(cls, spec):
+        '''
+        Return form field for `spec`.
+        '''
+        if isinstance(spec.filter_field, forms.Field):
+            return spec.filter_field
+        field_cls, local_field_kwargs = spec.filter_field
+        field_kwargs = cls.default_fields_args.copy()
+        field_kwargs.update(local_field_kwargs)
+        return field_cls(**field_kwargs)
+
     def clean(self):
         '''
         Cleaning phase of `FilterForm` is aimed to collect arguments for
@@ -68,29 +171,26 @@ class FilterFormBase(forms.Form):
         As a result we will get three new artefacts:
           * return value: a mapping to use as keyword arguments in `filter`;
           * `complex_conditions`: a `Q` object to use as a positional argument;
-          * `extra_conditions`: a mapping to use as keyword arguments in
-            `extra`.
+          * `extra_conditions`: an `Extra` object with conditions to apply
+            with `extra` (merged from all specs).
+
+        Specs with non-empty lookups are collected in `active_specs`
+        (spec name -> (cleaned value, lookup)).
         '''
-        simple_lookups = []
-        complex_conditions = []
-        extra_conditions = []
-        for name, spec in self.filter_specs.iteritems():
-            raw_value = self.cleaned_data.get(name)
-            if isinstance(spec, RuntimeAwareFilterSpecMixin):
-                lookup_or_condition = spec.to_lookup(raw_value, runtime_context=self.runtime_context)
-            else:
-                lookup_or_condition = spec.to_lookup(raw_value)
-
-            if isinstance(lookup_or_condition, Q) and lookup_or_condition:
-                    complex_conditions.append(lookup_or_condition)
-            elif isinstance(lookup_or_condition, Extra):
-                extra_conditions.append(lookup_or_condition)
-            elif lookup_or_condition:
-                simple_lookups.append(lookup_or_condition)
+        simple_lookups, complex_conditions, extra_conditions, active_specs = \
+            collect_lookups(self.filter_specs, self.cleaned_data,
+                            self.runtime_context)
 
         self.simple_lookups = simple_lookups
         self.complex_conditions = complex_conditions
         self.extra_conditions = extra_conditions
+        self.active_specs = active_specs
+
+        self.total_cost = sum(self.filter_specs[name].cost
+                              for name in active_specs)
+        if self.max_cost is not None and self.total_cost > self.max_cost:
+            self.over_budget = True
+            raise forms.ValidationError(self.error_messages['too_expensive'])
 
         return {}
 
@@ -124,36 +224,137 @@ class FilterFormBase(forms.Form):
             not self.complex_conditions and
             not self.extra_conditions)
 
+    def get_query_hints(self):
+        '''
+        Return query hints for the filtered queryset: mapping of
+        'select_related', 'prefetch_related' and 'only' to lists of field
+        names, declared on the form and on active specs.
+        '''
+        hints = {}
+        specs = [self.filter_specs[name] for name in self.active_specs]
+        for hint in ('select_related', 'prefetch_related', 'only'):
+            names = list(getattr(self, hint))
+            for spec in specs:
+                for name in getattr(spec, hint):
+                    if name not in names:
+                        names.append(name)
+            hints[hint] = names
+        return hints
+
+    def apply_query_hints(self, queryset):
+        hints = self.get_query_hints()
+        if hints['select_related']:
+            queryset = queryset.select_related(*hints['select_related'])
+        if hints['prefetch_related']:
+            queryset = queryset.prefetch_related(*hints['prefetch_related'])
+        if hints['only']:
+            queryset = queryset.only(*hints['only'])
+        return queryset
+
+    def add_error(self, message):
+        '''
+        Add non-field error, making the form invalid.
+        '''
+        errors = self._errors.setdefault(NON_FIELD_ERRORS, self.error_class())
+        errors.append(message)
+
+    def check_estimate(self, queryset, filtered_queryset):
+        '''
+        Return `filtered_queryset` if query planner doesn't expect more than
+        `max_estimated_rows` rows, otherwise invalidate the form and return
+        empty `queryset`.
+        '''
+        if self.max_estimated_rows is None:
+            return filtered_queryset
+        estimate = estimate_rows(filtered_queryset)
+        if estimate is not None and estimate > self.max_estimated_rows:
+            self.over_budget = True
+            self.add_error(self.error_messages['too_expensive'])
+            return queryset.none()
+        return filtered_queryset
+
+    def query_guard(self, using):
+        '''
+        Return context manager to evaluate filtered queries in.
+
+        Queries running longer than `statement_timeout` are aborted with
+        `datafilters.guard.QueryTimeout` (see `handle_timeout`).
+        '''
+        return statement_timeout(self.statement_timeout, using)
+
+    def handle_timeout(self):
+        self.add_error(self.error_messages['timeout'])
+
+    def track_stats(self, filtered_queryset):
+        if self.stats_collector is None:
+            return filtered_queryset
+        return self.stats_collector.track(self, filtered_queryset)
+
     def filter_bulk(self, queryset):
         if self.is_valid():
-            simple_lookups = self.simple_lookups
-            complex_conditions = self.complex_conditions
-            extra_conditions = self.get_extra_conditions()
-            if extra_conditions:
-                queryset = queryset.extra(**extra_conditions.as_kwargs())
-
-            lookup = join_dicts(simple_lookups)
-            return queryset.filter(*complex_conditions, **lookup)
+            filtered = apply_lookups(queryset, self.simple_lookups,
+                                     self.complex_conditions,
+                                     self.get_extra_conditions())
+            filtered = self.check_estimate(queryset, filtered)
+            return self.track_stats(filtered)
+        elif self.over_budget:
+            return queryset.none()
         else:
             return queryset
 
     def filter_chaining(self, queryset):
         if self.is_valid():
-            simple_lookups = self.simple_lookups
-            complex_conditions = self.complex_conditions
-            extra_conditions = self.get_extra_conditions()
-            if extra_conditions:
-                queryset = queryset.extra(**extra_conditions.as_kwargs())
+            filtered = apply_lookups(queryset, self.simple_lookups,
+                                     self.complex_conditions,
+                                     self.get_extra_conditions(),
+                                     use_filter_chaining=True)
+            filtered = self.check_estimate(queryset, filtered)
+            return self.track_stats(filtered)
+        elif self.over_budget:
+            return queryset.none()
 
-            for lookup in simple_lookups:
-                if lookup:
-                    queryset = queryset.filter(**lookup)
+        return queryset
 
-            for query in complex_conditions:
-                if query:
-                    queryset = queryset.filter(query)
+    def filter_sharded(self, queryset, using=None, **kwargs):
+        '''
+        Filter `queryset` on each of `using` databases (`shard_databases`
+        by default) and return `datafilters.sharding.ShardedQuerySet`
+        combining the results (`kwargs` are passed to it).
+        '''
+        if using is None:
+            using = self.shard_databases
+        return ShardedQuerySet([self.filter(queryset.using(alias))
+                                for alias in using], **kwargs)
 
-        return queryset
+    def filter_without(self, queryset, *spec_names):
+        '''
+        Filter queryset with active specs except `spec_names` (e.g. to count
+        facets of a spec under the other filters).
+        '''
+        return self._filter_active(queryset,
+                                   lambda name: name not in spec_names)
+
+    def filter_only(self, queryset, *spec_names):
+        '''
+        Filter queryset with active specs from `spec_names` only.
+        '''
+        return self._filter_active(queryset, lambda name: name in spec_names)
+
+    def _filter_active(self, queryset, include):
+        # Active specs and the cost policy are known after validation
+        if not self.is_valid():
+            if self.over_budget:
+                return queryset.none()
+            return queryset
+        filter_specs = SortedDict(
+            (name, self.filter_specs[name]) for name in self.active_specs
+            if include(name))
+        cleaned_data = dict((name, value) for name, (value, _lookup)
+                            in self.active_specs.items())
+        simple_lookups, complex_conditions, extra_conditions, _active = \
+            collect_lookups(filter_specs, cleaned_data, self.runtime_context)
+        return apply_lookups(queryset, simple_lookups, complex_conditions,
+                             extra_conditions, self.use_filter_chaining)
 
 
 class FilterForm(FilterFormBase):
@@ -9,9 +9,18 @@ __all__ = (
 class FilterSpec(object):
     creation_counter = 0
     field_cls = forms.CharField
+    # Weight of the spec in the cost policy of a filter form (see
+    # `FilterFormBase.max_cost`)
+    cost = 1
+    # Query hints applied to filtered querysets when the spec is active
+    # (see `FilterFormBase.get_query_hints`)
+    select_related = ()
+    prefetch_related = ()
+    only = ()
 
     def __init__(self, field_name, verbose_name=None,
-            filter_field=None, field_cls=None,
+            filter_field=None, field_cls=None, cost=None,
+            select_related=None, prefetch_related=None, only=None,
             **field_kwargs):
 
         # NOTE: Backward compatibility: previously label was provided with
@@ -21,6 +30,14 @@ class FilterSpec(object):
                 field_kwargs['label'] = verbose_name
 
         self.field_name = field_name
+        if cost is not None:
+            self.cost = cost
+        if select_related is not None:
+            self.select_related = select_related
+        if prefetch_related is not None:
+            self.prefetch_related = prefetch_related
+        if only is not None:
+            self.only = only
 
         if filter_field is not None:
             self.filter_field = filter_field
@@ -45,6 +62,14 @@ class FilterSpec(object):
     def to_lookup(self, cleaned_value):
         return {self.field_name: cleaned_value} if cleaned_value else {}
 
+    def get_index_choices(self):
+        '''
+        Return cleaned values that can be precomputed by
+        `datafilters.bitmap_index.BitmapIndex`, or `None` if spec is not
+        indexable (the default).
+        '''
+        return None
+
 
 class RuntimeAwareFilterSpecMixin(object):
     '''
@@ -0,0 +1,103 @@
+'''
+Protection against runaway filtered queries.
+
+  * `estimate_rows` asks the database planner (EXPLAIN) how many rows a
+    queryset will produce;
+  * `statement_timeout` aborts queries running longer than a timeout and
+    raises `QueryTimeout`.
+
+Both are used by `FilterFormBase` cost policy (`max_cost`,
+`max_estimated_rows` and `statement_timeout` attributes).
+'''
+import re
+import time
+from contextlib import contextmanager
+
+from django.db import connections, transaction, DatabaseError, \
+    DEFAULT_DB_ALIAS
+
+__all__ = ('QueryTimeout', 'estimate_rows', 'statement_timeout')
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+def estimate_rows(queryset):
+    '''
+    Return number of rows estimated by the query planner, or `None` if
+    database backend doesn't provide estimates (e.g. SQLite).
+    '''
+    connection = connections[queryset.db]
+    if connection.vendor not in ('postgresql', 'mysql'):
+        return None
+
+    compiler = queryset.query.get_compiler(using=queryset.db)
+    sql, params = compiler.as_sql()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN ' + sql, params)
+
+    if connection.vendor == 'postgresql':
+        # Top plan node: "Seq Scan on ...  (cost=0.00..1.10 rows=10 width=4)"
+        match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+        return int(match.group(1)) if match else None
+
+    # MySQL: rows examined by a join are the product of per-table rows
+    columns = [column[0] for column in cursor.description]
+    rows_index = columns.index('rows')
+    estimate = 1
+    for row in cursor.fetchall():
+        estimate *= row[rows_index] or 1
+    return estimate
+
+
+def _set_timeout(connection, timeout):
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute('SET statement_timeout = %s', [int(timeout)])
+    elif connection.vendor == 'mysql':
+        cursor.execute('SET SESSION max_execution_time = %s', [int(timeout)])
+    elif connection.vendor == 'sqlite':
+        deadline = time.time() + timeout / 1000.0
+        connection.connection.set_progress_handler(
+            lambda: int(time.time() > deadline), 1000)
+
+
+def _reset_timeout(connection):
+    if connection.vendor == 'postgresql':
+        connection.cursor().execute('SET statement_timeout = DEFAULT')
+    elif connection.vendor == 'mysql':
+        connection.cursor().execute('SET SESSION max_execution_time = DEFAULT')
+    elif connection.vendor == 'sqlite':
+        connection.connection.set_progress_handler(None, 1000)
+
+
+@contextmanager
+def statement_timeout(timeout, using=DEFAULT_DB_ALIAS):
+    '''
+    Abort queries executed within the block if they run longer than
+    `timeout` milliseconds (`None` disables the limit).
+
+    Database errors raised after the timeout has passed are reported as
+    `QueryTimeout`.
+    '''
+    if timeout is None:
+        yield
+        return
+
+    connection = connections[using]
+    started = time.time()
+    _set_timeout(connection, timeout)
+    try:
+        yield
+    except DatabaseError:
+        if (time.time() - started) * 1000 < timeout:
+            raise
+        transaction.rollback_unless_managed(using=using)
+        raise QueryTimeout('Query exceeded %s ms' % timeout)
+    finally:
+        try:
+            _reset_timeout(connection)
+        except DatabaseError:
+            # Transaction is aborted, timeout is reset with the connection
+            pass
@@ -0,0 +1,78 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from datafilters.analytics import CacheStatsStorage, SQLiteStatsStorage, \
+    OVERFLOW
+from datafilters.utils import import_by_path
+
+ORDERINGS = ('avg', 'max', 'total', 'uses')
+
+
+def percentile_bound(histogram, fraction):
+    '''
+    Return upper bound of the latency bucket containing the given fraction
+    of queries.
+    '''
+    total = sum(histogram.values())
+    if not total:
+        return None
+    buckets = sorted(histogram.items(),
+                     key=lambda item: (item[0] == OVERFLOW, item[0]))
+    seen = 0
+    for bound, hits in buckets:
+        seen += hits
+        if seen >= fraction * total:
+            return bound
+    return OVERFLOW
+
+
+class Command(BaseCommand):
+    help = ('Print the slowest filter spec combinations recorded by a '
+            '`FilterStatsCollector` (given by dotted path, default: '
+            'DATAFILTERS_STATS_COLLECTOR setting, or the cache storage).')
+    args = '[collector_path]'
+    option_list = BaseCommand.option_list + (
+        make_option('--file', dest='file', default=None,
+                    help='Read statistics from a SQLite file.'),
+        make_option('--limit', dest='limit', type='int', default=20,
+                    help='Number of combinations to print.'),
+        make_option('--order', dest='order', default='avg',
+                    type='choice', choices=ORDERINGS,
+                    help='Sort by average or maximum latency, total time '
+                         'or number of uses.'),
+    )
+
+    def get_storage(self, collector_path, options):
+        if options.get('file'):
+            return SQLiteStatsStorage(options['file'])
+        if collector_path is None:
+            collector_path = getattr(settings, 'DATAFILTERS_STATS_COLLECTOR',
+                                     None)
+        if collector_path is not None:
+            return import_by_path(collector_path).storage
+        return CacheStatsStorage()
+
+    def handle(self, collector_path=None, **options):
+        stats = self.get_storage(collector_path, options).load()
+
+        def sort_key(item):
+            _key, s = item
+            average = s['total_time'] / s['queries'] if s['queries'] else 0
+            return {
+                'avg': average,
+                'max': s['max_time'],
+                'total': s['total_time'],
+                'uses': s['uses'],
+            }[options.get('order', 'avg')]
+
+        rows = sorted(stats.items(), key=sort_key, reverse=True)
+        self.stdout.write('%10s %10s %8s %8s %8s  %s\n' % (
+            'avg ms', 'max ms', 'p95 ms', 'uses', 'queries', 'specs'))
+        for key, s in rows[:int(options.get('limit', 20))]:
+            average = s['total_time'] / s['queries'] if s['queries'] else 0
+            self.stdout.write('%10.1f %10.1f %8s %8d %8d  %s\n' % (
+                average * 1000, s['max_time'] * 1000,
+                percentile_bound(s['histogram'], 0.95) or '-',
+                s['uses'], s['queries'], key or '(no filters)'))
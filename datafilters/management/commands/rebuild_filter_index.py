@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from datafilters.bitmap_index import registry
+from datafilters.utils import import_by_path
+
+
+class Command(BaseCommand):
+    help = ('Rebuild bitmap indexes of filter specs. Indexes are given by '
+            'dotted paths to `BitmapIndex` instances (default: '
+            'DATAFILTERS_INDEXES setting).')
+    args = '[index_path ...]'
+
+    def handle(self, *index_paths, **options):
+        if not index_paths:
+            index_paths = getattr(settings, 'DATAFILTERS_INDEXES', ())
+
+        # Importing an index registers it
+        indexes = []
+        for path in index_paths:
+            try:
+                indexes.append(import_by_path(path))
+            except (ImportError, AttributeError, ValueError) as e:
+                raise CommandError('Can\'t import %s: %s' % (path, e))
+        if not indexes:
+            indexes = registry.values()
+        if not indexes:
+            raise CommandError('No indexes to rebuild: give dotted paths to '
+                               'them or set DATAFILTERS_INDEXES')
+
+        for index in indexes:
+            index.rebuild()
+            if int(options.get('verbosity', 1)) > 0:
+                self.stdout.write('Rebuilt index %s\n' % index.name)
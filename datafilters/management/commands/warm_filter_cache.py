@@ -0,0 +1,191 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import resolve, Resolver404
+from django.db import models
+from django.db.models.query import QuerySet
+from django.test.client import RequestFactory
+from django.utils.importlib import import_module
+
+from datafilters.concurrency import run_queries
+from datafilters.filterform import FilterFormBase
+from datafilters.results import FilterResultCache
+from datafilters.utils import import_by_path
+
+
+def parse_entries(lines):
+    entries = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            entries.append(line)
+    return entries
+
+
+def parse_aggregate(spec):
+    '''
+    Parse an aggregate given as 'alias=Function:lookup' ('votes=Sum:votes').
+    '''
+    try:
+        alias, definition = spec.split('=', 1)
+        name, lookup = definition.split(':', 1)
+        aggregate = getattr(models, name)
+    except (ValueError, AttributeError):
+        raise CommandError('Invalid aggregate %r, expected '
+                           '"alias=Function:lookup"' % spec)
+    return alias, aggregate(lookup)
+
+
+def get_queryset(source):
+    '''
+    Return a queryset from a model, manager, queryset or a function
+    returning one of them.
+    '''
+    if callable(source) and not isinstance(source, type):
+        source = source()
+    if isinstance(source, QuerySet):
+        return source._clone()
+    if isinstance(source, models.Manager):
+        return source.all()
+    return source._default_manager.all()
+
+
+class Command(BaseCommand):
+    help = ('Warm caches of filtered views by requesting them with given '
+            'filter parameters. Entries are URLs ("/polls/?has_major_choice'
+            '=true") or dotted paths to views with a query string '
+            '("polls.views.poll_list?has_major_choice=true"). Filter forms '
+            'are warmed by dotted paths too: a form alone loads its choices, '
+            'a form with a queryset ("polls.filters.ChoicesFilterForm:'
+            'polls.models.Choice?poll=3") stores count, aggregates and the '
+            'first page in the result cache.')
+    args = '[entry ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--file', dest='file', default=None,
+                    help='Read entries from a file, one per line.'),
+        make_option('--concurrency', dest='concurrency', type='int',
+                    default=4,
+                    help='Maximum number of entries warmed at once.'),
+        make_option('--result-cache', dest='result_cache', default=None,
+                    help='Dotted path to the FilterResultCache used by views '
+                         'of form and queryset entries.'),
+        make_option('--aggregate', dest='aggregates', action='append',
+                    default=[],
+                    help='Aggregate of form and queryset entries, as '
+                         '"alias=Function:lookup" (e.g. "votes=Sum:votes").'),
+        make_option('--page-size', dest='page_size', type='int',
+                    default=None,
+                    help='Number of objects of the first page of form and '
+                         'queryset entries.'),
+    )
+
+    result_cache = None
+    aggregate_args = {}
+    page_size = None
+
+    def get_view(self, path):
+        '''
+        Return (view, args, kwargs, request path) for an entry path.
+        '''
+        if path.startswith('/'):
+            try:
+                match = resolve(path)
+            except Resolver404:
+                raise CommandError('No view found for %s' % path)
+            return match.func, match.args, match.kwargs, path
+
+        path, _sep, source_path = path.partition(':')
+        view = self.import_object(path)
+        if isinstance(view, type) and issubclass(view, FilterFormBase):
+            source = None
+            if source_path:
+                if self.result_cache is None:
+                    raise CommandError('Give --result-cache to warm results '
+                                       'of %s' % source_path)
+                source = self.import_object(source_path)
+            return self.get_form_view(view, source), (), {}, '/'
+        if source_path:
+            raise CommandError('%s is not a filter form' % path)
+        if hasattr(view, 'as_view'):
+            view = view.as_view()
+        return view, (), {}, '/'
+
+    def import_object(self, path):
+        try:
+            return import_by_path(path)
+        except (ImportError, AttributeError, ValueError) as e:
+            raise CommandError('Can\'t import %s: %s' % (path, e))
+
+    def get_form_view(self, filterform_cls, source=None):
+        '''
+        Return a view warming choices of the form's fields and, if a
+        queryset `source` is given, results of the filtered queryset.
+        '''
+        def warm_form(request):
+            filterform = filterform_cls(request.GET)
+            for field in filterform.fields.values():
+                list(getattr(field, 'choices', ()))
+            if source is not None:
+                self.result_cache.warm(filterform, get_queryset(source),
+                                       aggregate_args=self.aggregate_args,
+                                       page_size=self.page_size)
+        return warm_form
+
+    def make_request(self, path, query_string):
+        request = RequestFactory().get('%s?%s' % (path, query_string))
+        # Anonymous visitor with a fresh session
+        request.user = AnonymousUser()
+        engine = import_module(settings.SESSION_ENGINE)
+        request.session = engine.SessionStore()
+        return request
+
+    def warm(self, entry):
+        path, _sep, query_string = entry.partition('?')
+        view, args, kwargs, request_path = self.get_view(path)
+        started = time.time()
+        try:
+            response = view(self.make_request(request_path, query_string),
+                            *args, **kwargs)
+            if hasattr(response, 'render') and \
+                    not getattr(response, 'is_rendered', True):
+                response.render()
+            status = getattr(response, 'status_code', '-')
+        except Exception as e:
+            status = 'error: %s' % e
+        return entry, time.time() - started, status
+
+    def handle(self, *entries, **options):
+        entries = list(entries)
+        if options.get('file'):
+            with open(options['file']) as f:
+                entries.extend(parse_entries(f))
+        if not entries:
+            raise CommandError('No entries to warm')
+
+        if options.get('result_cache'):
+            self.result_cache = self.import_object(options['result_cache'])
+            if not isinstance(self.result_cache, FilterResultCache):
+                raise CommandError('%s is not a FilterResultCache'
+                                   % options['result_cache'])
+        self.aggregate_args = dict(parse_aggregate(spec)
+                                   for spec in options.get('aggregates') or [])
+        self.page_size = options.get('page_size')
+
+        # Fail early on unknown views
+        for entry in entries:
+            self.get_view(entry.partition('?')[0])
+
+        started = time.time()
+        results = run_queries(
+            [(lambda entry=entry: self.warm(entry)) for entry in entries],
+            settings.DATABASES.keys(), int(options.get('concurrency', 4)))
+
+        if int(options.get('verbosity', 1)) > 0:
+            for entry, seconds, status in results:
+                self.stdout.write('%10.1f ms  %s  %s\n'
+                                  % (seconds * 1000, status, entry))
+            self.stdout.write('Warmed %d entries in %.1f ms\n'
+                              % (len(results), (time.time() - started) * 1000))
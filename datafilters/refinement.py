@@ -0,0 +1,220 @@
+'''
+Reuse of recent filter results when a user narrows down a filter.
+
+`RefinementCache` remembers primary keys matched by recent filter states
+of the user. When a new state adds specs to a remembered one, only the
+added specs are applied, to rows with remembered keys::
+
+    refinement = RefinementCache(Choice, dependencies=(Poll,))
+
+    class ChoiceListView(FilterFormMixin, ListView):
+        refinement_cache = refinement
+        ...
+
+Keys are kept in the datafilters cache, under a token of the user's
+session; the session holds only descriptions of the states and is written
+only when a state is added. Repeated states are answered from the cache
+without queries.
+
+Remembered results are dropped after `timeout` seconds and on changes of
+the model and its `dependencies` (see
+`datafilters.cache.track_model_version`). Keys of results with more than
+`max_ids` rows are not remembered (keep it below 999 for SQLite, which
+limits the number of query parameters); such states are remembered as
+oversized, so broader filters are not counted again.
+'''
+import time
+import uuid
+
+from django.db.models import Q
+from django.utils.datastructures import SortedDict
+
+from datafilters.cache import describe_queryset, get_filter_cache, \
+    get_model_version, make_key, track_model_version
+from datafilters.extra_lookup import Extra
+from datafilters.utils import spans_multivalued_relation
+
+__all__ = ('RefinementCache',)
+
+
+def describe_lookup(lookup):
+    if isinstance(lookup, Extra):
+        return repr((lookup.where_groups, lookup.tables,
+                     [(c.field_name, c.sql, c.params)
+                      for c in lookup.conditions]))
+    if isinstance(lookup, dict):
+        return repr(sorted(lookup.items()))
+    return str(lookup)
+
+
+def get_lookup_keys(lookup):
+    if isinstance(lookup, dict):
+        return lookup.keys()
+    keys = []
+    for child in lookup.children:
+        if isinstance(child, Q):
+            keys.extend(get_lookup_keys(child))
+        else:
+            keys.append(child[0])
+    return keys
+
+
+def spans_multivalued(model, lookup):
+    if isinstance(lookup, Extra):
+        if lookup.where_groups or lookup.tables:
+            # Custom SQL may join anything
+            return True
+        keys = [condition.field_name for condition in lookup.conditions]
+    else:
+        keys = get_lookup_keys(lookup)
+    return any(spans_multivalued_relation(model, key) for key in keys)
+
+
+class RefinementCache(object):
+    '''
+    Primary keys of up to `max_states` recent filter states of `model`
+    querysets, kept for `timeout` seconds.
+    '''
+
+    session_key = 'datafilters_refinement'
+
+    def __init__(self, model, max_states=5, timeout=300, max_ids=500,
+            dependencies=()):
+        self.model = model
+        self.max_states = max_states
+        self.timeout = timeout
+        self.max_ids = max_ids
+        self.dependencies = dependencies
+        for dependency in (model,) + tuple(dependencies):
+            track_model_version(dependency)
+
+    def get_base_key(self, queryset):
+        versions = [get_model_version(model)
+                    for model in (self.model,) + tuple(self.dependencies)]
+        return make_key('refinement', describe_queryset(queryset), versions)
+
+    def get_signature(self, filterform):
+        '''
+        Return mapping of active spec names to hashes of their lookups.
+        '''
+        return SortedDict(
+            (name, make_key('lookup', name, describe_lookup(lookup)))
+            for name, (_value, lookup) in filterform.active_specs.items())
+
+    def can_refine(self, filterform):
+        if filterform.use_filter_chaining:
+            return True
+        # Conditions on multi-valued relations in one `filter` call must
+        # hold for the same related row, so they can't be applied one by
+        # one
+        multivalued = [name for name, (_value, lookup)
+                       in filterform.active_specs.items()
+                       if spans_multivalued(self.model, lookup)]
+        return len(multivalued) < 2
+
+    def get_states(self, request):
+        '''
+        Return (session token, live states) of the request's session.
+        '''
+        data = request.session.get(self.session_key) or {}
+        now = time.time()
+        return data.get('token'), [state for state in data.get('states', [])
+                                   if state['time'] + self.timeout > now]
+
+    def get_ids(self, state):
+        return get_filter_cache().get(state['key'])
+
+    def find_state(self, states, base_key, signature):
+        '''
+        Return (state, ids) of the smallest remembered result with a subset
+        of the `signature` specs, or (None, None).
+        '''
+        hashes = set(signature.values())
+        candidates = [state for state in states
+                      if state['base'] == base_key and
+                      state['key'] is not None and
+                      set(state['specs']) <= hashes]
+        candidates.sort(key=lambda state: state['size'])
+        for state in candidates:
+            ids = self.get_ids(state)
+            if ids is not None:
+                return state, ids
+        return None, None
+
+    def is_oversized(self, states, base_key, signature):
+        '''
+        Return `True` if a remembered oversized result has a superset of the
+        `signature` specs, so this result is not smaller.
+        '''
+        hashes = set(signature.values())
+        return any(state['base'] == base_key and state['key'] is None and
+                   set(state['specs']) >= hashes
+                   for state in states)
+
+    def add_state(self, request, token, states, base_key, signature, ids):
+        '''
+        Remember keys `ids` of the filter state, or the state as oversized
+        if `ids` is `None`.
+        '''
+        if token is None:
+            token = uuid.uuid4().hex
+        specs = sorted(signature.values())
+        if ids is None:
+            key = None
+        else:
+            key = make_key('refinement-ids', token, base_key, specs)
+            get_filter_cache().set(key, ids, self.timeout)
+        states = [s for s in states
+                  if not (s['base'] == base_key and
+                          sorted(s['specs']) == specs)]
+        states.insert(0, {
+            'base': base_key,
+            'specs': specs,
+            'key': key,
+            'size': None if ids is None else len(ids),
+            'time': time.time(),
+        })
+        request.session[self.session_key] = {
+            'token': token,
+            'states': states[:self.max_states],
+        }
+
+    def filter(self, request, filterform, queryset):
+        '''
+        Return `queryset` filtered with the valid `filterform` (without
+        duplicates), reusing a remembered state if possible.
+        '''
+        if getattr(request, 'session', None) is None:
+            return filterform.filter(queryset).distinct()
+
+        base_key = self.get_base_key(queryset)
+        signature = self.get_signature(filterform)
+        token, states = self.get_states(request)
+
+        state = ids = None
+        if signature and self.can_refine(filterform):
+            state, ids = self.find_state(states, base_key, signature)
+        if state is not None:
+            added = [name for name, key in signature.items()
+                     if key not in state['specs']]
+            if not added:
+                # The same state is requested again
+                return queryset.filter(pk__in=ids)
+            filtered = filterform.filter_only(
+                queryset.filter(pk__in=ids), *added)
+        else:
+            filtered = filterform.filter(queryset)
+
+        # The form is invalidated by the cost policy in `filter`
+        if (not signature or not filterform.is_valid() or
+                self.is_oversized(states, base_key, signature)):
+            return filtered.distinct()
+
+        ids = list(filtered.order_by().values_list('pk', flat=True)
+                   .distinct()[:self.max_ids + 1])
+        if len(ids) > self.max_ids:
+            self.add_state(request, token, states, base_key, signature, None)
+            return filtered.distinct()
+
+        self.add_state(request, token, states, base_key, signature, ids)
+        return queryset.filter(pk__in=ids)
@@ -0,0 +1,94 @@
+'''
+Cache for counts, aggregates and pages of filtered querysets.
+
+`FilterResultCache` keeps results of the queries `filter_powered` runs for
+a filtered queryset, keyed by the query (but not the database alias, so
+results are shared by replicas and the primary)::
+
+    choice_results = FilterResultCache(Choice, dependencies=(Poll,))
+
+    @filter_powered(ChoicesFilterForm, queryset_name='choices',
+                    add_count=True, page_size=20,
+                    result_cache=choice_results)
+    ...
+
+Results can be computed in advance with `warm` (see the
+`warm_filter_cache` command). They are dropped after `timeout` seconds and
+on changes of the model and its `dependencies` (see
+`datafilters.cache.track_model_version`).
+'''
+from datafilters.cache import describe_aggregates, describe_queryset, \
+    get_filter_cache, get_model_version, make_key, track_model_version
+
+__all__ = ('FilterResultCache',)
+
+
+class FilterResultCache(object):
+    '''
+    Counts, aggregates and pages of querysets of `model` cached for
+    `timeout` seconds.
+    '''
+
+    def __init__(self, model, timeout=300, dependencies=()):
+        self.model = model
+        self.timeout = timeout
+        self.dependencies = dependencies
+        for dependency in (model,) + tuple(dependencies):
+            track_model_version(dependency)
+
+    def get_key(self, kind, queryset, *parts):
+        versions = [get_model_version(model)
+                    for model in (self.model,) + tuple(self.dependencies)]
+        return make_key('results', kind, describe_queryset(queryset)[1:],
+                        versions, parts)
+
+    def get(self, key, compute):
+        cache = get_filter_cache()
+        value = cache.get(key)
+        if value is None:
+            value = compute()
+            cache.set(key, value, self.timeout)
+        return value
+
+    def count(self, queryset):
+        '''
+        Return `queryset.count()`, cached.
+        '''
+        return self.get(self.get_key('count', queryset), queryset.count)
+
+    def aggregate(self, queryset, aggregate_args):
+        '''
+        Return `queryset.aggregate(**aggregate_args)`, cached.
+        '''
+        key = self.get_key('aggregate', queryset,
+                           describe_aggregates(aggregate_args))
+        return self.get(key, lambda: queryset.aggregate(**aggregate_args))
+
+    def page(self, object_list):
+        '''
+        Return list of objects of the (sliced) `object_list`, cached.
+        '''
+        return self.get(self.get_key('page', object_list),
+                        lambda: list(object_list))
+
+    def warm(self, filterform, queryset, add_count=True, aggregate_args={},
+            page_size=None):
+        '''
+        Compute and store results of `queryset` filtered with `filterform`
+        under the keys `filter_powered` reads: count, aggregates and the
+        first page of `page_size` objects.
+        '''
+        cache = get_filter_cache()
+        queryset = filterform.filter(queryset).distinct()
+        if add_count:
+            cache.set(self.get_key('count', queryset), queryset.count(),
+                      self.timeout)
+        if aggregate_args:
+            key = self.get_key('aggregate', queryset,
+                               describe_aggregates(aggregate_args))
+            cache.set(key, queryset.aggregate(**aggregate_args),
+                      self.timeout)
+        if page_size is not None:
+            object_list = filterform.apply_query_hints(queryset)[:page_size]
+            cache.set(self.get_key('page', object_list), list(object_list),
+                      self.timeout)
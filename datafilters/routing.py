@@ -0,0 +1,128 @@
+'''
+Routing of read-only filtered queries to a replica database.
+
+Filter forms and views accept `read_database`, an alias from `DATABASES`.
+Filtered querysets (and thus counts and aggregates) are sent there with
+`QuerySet.using`, except when:
+
+  * the replica connection can't be established;
+  * the client wrote data recently (within `DATAFILTERS_REPLICATION_LAG`
+    seconds, 5 by default), so it would not see its own changes. Writes
+    are marked in the session with `mark_write` or `WriteMarkerMiddleware`.
+
+Reads of routed querysets are run with `ReplicaFallback`, which repeats a
+read on the primary database if the replica fails with `DatabaseError`.
+'''
+import logging
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+__all__ = (
+    'ReplicaFallback',
+    'WriteMarkerMiddleware',
+    'get_read_database',
+    'mark_write',
+    'route_queryset',
+)
+
+logger = logging.getLogger('datafilters')
+
+WRITE_MARKER_SESSION_KEY = 'datafilters_last_write'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+
+def mark_write(request):
+    '''
+    Remember in the session that the client has just written data.
+    '''
+    session = getattr(request, 'session', None)
+    if session is not None:
+        session[WRITE_MARKER_SESSION_KEY] = time.time()
+
+
+def get_read_database(request, alias, replication_lag=None):
+    '''
+    Return database alias to read filtered data from: `alias` or `None`
+    if primary database must be used.
+    '''
+    if not alias:
+        return None
+
+    if replication_lag is None:
+        replication_lag = getattr(settings, 'DATAFILTERS_REPLICATION_LAG', 5)
+    session = getattr(request, 'session', None)
+    if session is not None:
+        last_write = session.get(WRITE_MARKER_SESSION_KEY)
+        if last_write is not None and time.time() - last_write < replication_lag:
+            return None
+
+    try:
+        connections[alias].cursor()
+    except Exception:
+        # Unknown alias or driver-specific connection error
+        logger.warning('Database %r is unavailable, reading from primary',
+                       alias, exc_info=True)
+        return None
+    return alias
+
+
+def route_queryset(request, queryset, alias, replication_lag=None):
+    '''
+    Return queryset bound to the read database (see `get_read_database`).
+    '''
+    alias = get_read_database(request, alias, replication_lag)
+    if alias is None:
+        return queryset
+    return queryset.using(alias)
+
+
+class ReplicaFallback(object):
+    '''
+    Runner of reads of querysets routed away from the `primary` database
+    alias. Once a read fails with `DatabaseError`, it is repeated on the
+    primary database, as are all later reads.
+    '''
+
+    def __init__(self, primary):
+        self.primary = primary
+        self.failed = False
+
+    def using(self, queryset):
+        '''
+        Return `queryset` bound to the primary database if the replica has
+        failed.
+        '''
+        if self.failed and queryset.db != self.primary:
+            return queryset.using(self.primary)
+        return queryset
+
+    def read(self, func, queryset):
+        '''
+        Return `func(queryset)`, calling `func` again with `queryset` bound
+        to the primary database if the replica fails.
+        '''
+        queryset = self.using(queryset)
+        try:
+            return func(queryset)
+        except DatabaseError:
+            if queryset.db == self.primary:
+                raise
+            logger.warning('Reading from %r failed, retrying on primary',
+                           queryset.db, exc_info=True)
+            self.failed = True
+            return func(queryset.using(self.primary))
+
+
+class WriteMarkerMiddleware(object):
+    '''
+    Mark writes for every successful request with unsafe method (POST,
+    PUT, DELETE, ...). Must be placed after `SessionMiddleware`.
+    '''
+
+    def process_response(self, request, response):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            mark_write(request)
+        return response
@@ -0,0 +1,299 @@
+'''
+Filtering data sharded across several databases.
+
+`ShardedQuerySet` applies the same lookups to a queryset on every database
+alias, queries shards concurrently and combines results::
+
+    polls = filterform.filter_sharded(Poll.objects.order_by('-pub_date'),
+                                      using=('shard1', 'shard2'))
+    polls.count()                      # sum of counts
+    polls.aggregate(votes=Sum('choice__votes'))
+    page = polls[20:40]                # merged by ordering of the queryset
+
+Ordered results are merged lazily (k-way merge), so only as many rows as
+needed are fetched from each shard. When iterated, shards are read on their
+own threads, at most `prefetch` rows ahead of the merge. Ordering is done in
+Python by field values of fetched rows (related objects of the ordering are
+selected with them), which must agree with the database ordering (e.g.
+collations of text fields).
+'''
+import heapq
+import itertools
+
+from django.db.models import Count, Sum
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import ValuesQuerySet
+from django.db.models.sql.constants import LOOKUP_SEP
+
+from datafilters.aggregates import DECOMPOSABLE_AGGREGATES
+from datafilters.concurrency import can_run_concurrently, \
+    prefetch_iterators, run_queries
+
+__all__ = ('ShardedQuerySet',)
+
+
+class Descending(object):
+    '''
+    Wrapper reversing comparison of a sort key value.
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+
+def get_ordering(queryset):
+    query = queryset.query
+    if query.order_by:
+        return list(query.order_by)
+    if query.default_ordering:
+        return list(query.get_meta().ordering)
+    return []
+
+
+def get_related_paths(model, ordering):
+    '''
+    Return paths of related objects (forward foreign keys) traversed by
+    `ordering` of `model` rows.
+    '''
+    paths = []
+    for name in ordering:
+        opts = model._meta
+        related = []
+        for part in name.lstrip('-').split(LOOKUP_SEP)[:-1]:
+            try:
+                field, _model, direct, m2m = opts.get_field_by_name(part)
+            except FieldDoesNotExist:
+                break
+            if not direct or m2m or getattr(field, 'rel', None) is None:
+                break
+            related.append(part)
+            opts = field.rel.to._meta
+        if related:
+            paths.append(LOOKUP_SEP.join(related))
+    return paths
+
+
+def flatten_related(tree, prefix=()):
+    '''
+    Return paths of leaves of `select_related` tree of a query.
+    '''
+    paths = []
+    for name, subtree in tree.items():
+        if subtree:
+            paths.extend(flatten_related(subtree, prefix + (name,)))
+        else:
+            paths.append(LOOKUP_SEP.join(prefix + (name,)))
+    return paths
+
+
+def select_ordering_related(queryset, ordering):
+    '''
+    Return `queryset` selecting related objects needed for sort keys, so
+    they are not loaded one by one when rows are merged.
+    '''
+    if isinstance(queryset, ValuesQuerySet):
+        return queryset
+    paths = get_related_paths(queryset.model, ordering)
+    selected = queryset.query.select_related
+    if not paths or selected is True:
+        return queryset
+    # Fields given to `select_related` replace those selected before
+    if selected:
+        paths = flatten_related(selected) + paths
+    return queryset.select_related(*paths)
+
+
+def resolve(row, path):
+    if isinstance(row, dict):
+        return row[LOOKUP_SEP.join(path)]
+    value = row
+    for name in path:
+        if value is None:
+            return None
+        if name != 'pk':
+            field = value._meta.get_field_by_name(name)[0]
+            # Related objects are ordered by their keys
+            if getattr(field, 'rel', None) is not None and \
+                    name == path[-1]:
+                name = field.attname
+        value = getattr(value, name)
+    return value
+
+
+def make_sort_key(ordering):
+    fields = []
+    for name in ordering:
+        if name == '?':
+            raise ValueError('Random ordering is not supported for shards')
+        descending = name.startswith('-')
+        fields.append((name.lstrip('-').split(LOOKUP_SEP), descending))
+
+    def sort_key(row):
+        key = []
+        for path, descending in fields:
+            value = resolve(row, path)
+            key.append(Descending(value) if descending else value)
+        return tuple(key)
+    return sort_key
+
+
+def merge_ordered(iterables, sort_key):
+    '''
+    Lazily merge iterables of rows sorted by `sort_key`.
+    '''
+    decorated = [((sort_key(row), shard, n, row)
+                  for n, row in enumerate(iterable))
+                 for shard, iterable in enumerate(iterables)]
+    for _key, _shard, _n, row in heapq.merge(*decorated):
+        yield row
+
+
+class ShardedQuerySet(object):
+    '''
+    Set of querysets, one per shard, combined into one result.
+    Shards are queried on at most `max_workers` threads (see
+    `datafilters.concurrency.run_queries`), except for iteration, which
+    reads every shard on its own thread (`max_workers=0` disables
+    threads).
+    '''
+
+    def __init__(self, querysets, max_workers=4, timeout=None,
+            prefetch=100):
+        self.querysets = list(querysets)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.prefetch = prefetch
+
+    @classmethod
+    def from_queryset(cls, queryset, using, **kwargs):
+        return cls([queryset.using(alias) for alias in using], **kwargs)
+
+    def _run(self, funcs):
+        return run_queries(funcs, [qs.db for qs in self.querysets],
+                           self.max_workers, self.timeout)
+
+    def _clone(self, querysets):
+        return self.__class__(querysets, self.max_workers, self.timeout,
+                              self.prefetch)
+
+    def filter(self, *args, **kwargs):
+        return self._clone([qs.filter(*args, **kwargs)
+                            for qs in self.querysets])
+
+    def distinct(self):
+        return self._clone([qs.distinct() for qs in self.querysets])
+
+    def order_by(self, *field_names):
+        return self._clone([qs.order_by(*field_names)
+                            for qs in self.querysets])
+
+    def count(self):
+        return sum(self._run([qs.count for qs in self.querysets]))
+
+    def aggregate(self, **aggregate_args):
+        '''
+        Combine aggregates of shards. Only `Count`, `Sum`, `Min`, `Max` and
+        `Avg` without `distinct` are supported.
+        '''
+        query_args = dict(aggregate_args)
+        for alias, aggregate in aggregate_args.items():
+            if (aggregate.name not in DECOMPOSABLE_AGGREGATES or
+                    aggregate.extra.get('distinct')):
+                raise ValueError("%s can't be combined across shards"
+                                 % aggregate.name)
+            if aggregate.name == 'Avg':
+                del query_args[alias]
+                query_args['datafilters_%s_sum' % alias] = \
+                    Sum(aggregate.lookup)
+                query_args['datafilters_%s_count' % alias] = \
+                    Count(aggregate.lookup)
+
+        shard_values = self._run([
+            (lambda qs=qs: qs.aggregate(**query_args))
+            for qs in self.querysets])
+
+        result = {}
+        for alias, aggregate in aggregate_args.items():
+            if aggregate.name == 'Avg':
+                total = sum(values['datafilters_%s_sum' % alias] or 0
+                            for values in shard_values)
+                count = sum(values['datafilters_%s_count' % alias] or 0
+                            for values in shard_values)
+                result[alias] = float(total) / count if count else None
+                continue
+            values = [v[alias] for v in shard_values if v[alias] is not None]
+            if aggregate.name in ('Count', 'Sum'):
+                result[alias] = sum(values) if values else None
+                if aggregate.name == 'Count':
+                    result[alias] = result[alias] or 0
+            elif aggregate.name == 'Min':
+                result[alias] = min(values) if values else None
+            else:
+                result[alias] = max(values) if values else None
+        return result
+
+    def get_sort_key(self):
+        ordering = get_ordering(self.querysets[0])
+        if not ordering:
+            return None
+        return make_sort_key(ordering)
+
+    def _sortable(self, querysets):
+        ordering = get_ordering(self.querysets[0])
+        return [select_ordering_related(qs, ordering) for qs in querysets]
+
+    def _merge(self, iterables):
+        sort_key = self.get_sort_key()
+        if sort_key is None:
+            return itertools.chain(*iterables)
+        return merge_ordered(iterables, sort_key)
+
+    def __iter__(self):
+        querysets = self._sortable(self.querysets)
+        if self.max_workers and all(can_run_concurrently(qs.db)
+                                    for qs in querysets):
+            # All shards are read at once, so each needs a thread
+            iterators = prefetch_iterators(
+                [qs.iterator for qs in querysets], self.prefetch)
+        else:
+            iterators = [qs.iterator() for qs in querysets]
+        return self._merge(iterators)
+
+    def __getitem__(self, k):
+        '''
+        Return list of merged rows: a page (slice) or a single row. At most
+        `stop` rows are fetched from each shard.
+        '''
+        if isinstance(k, slice):
+            if k.step is not None or (k.start or 0) < 0 or \
+                    (k.stop is not None and k.stop < 0):
+                raise ValueError('Only non-negative slices without step '
+                                 'are supported')
+            start, stop = k.start or 0, k.stop
+        else:
+            start, stop = k, k + 1
+
+        querysets = self._sortable(self.querysets)
+        if stop is not None:
+            querysets = [qs[:stop] for qs in querysets]
+        rows = self._run([(lambda qs=qs: list(qs)) for qs in querysets])
+        page = list(itertools.islice(self._merge(rows), start, stop))
+
+        if isinstance(k, slice):
+            return page
+        if not page:
+            raise IndexError('ShardedQuerySet index out of range')
+        return page[0]
@@ -0,0 +1,113 @@
+'''
+Coalescing of identical concurrent computations ("single flight").
+
+When several threads ask for the same key at once, only the first one runs
+the computation; others wait for it and share the result::
+
+    flight = SingleFlight()
+    result = flight.do(key, compute)
+
+`CacheSingleFlight` does the same across processes, using a lock and a
+short-lived result in the cache.
+'''
+import threading
+import time
+
+from datafilters.cache import get_filter_cache
+
+__all__ = ('CacheSingleFlight', 'SingleFlight')
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''
+    In-process single flight group.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        '''
+        Return result of `func()`, sharing it with concurrent calls for the
+        same key. Exceptions are propagated to all waiting callers.
+        '''
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+
+class CacheSingleFlight(object):
+    '''
+    Single flight group shared by processes using the same cache.
+
+    The process holding the lock (added to the cache for `lock_timeout`
+    seconds) runs the computation and stores the result for
+    `result_timeout` seconds; others poll the cache for it. If the lock
+    holder dies, the computation is run by the waiting process after
+    `lock_timeout`. Results must be picklable.
+    '''
+
+    def __init__(self, cache=None, lock_timeout=30, result_timeout=5,
+            poll_interval=0.05):
+        self.cache = cache
+        self.lock_timeout = lock_timeout
+        self.result_timeout = result_timeout
+        self.poll_interval = poll_interval
+        self.local = SingleFlight()
+
+    def get_cache(self):
+        return self.cache if self.cache is not None else get_filter_cache()
+
+    def do(self, key, func):
+        # Threads of one process are coalesced locally first
+        return self.local.do(key, lambda: self._do(key, func))
+
+    def _do(self, key, func):
+        cache = self.get_cache()
+        result_key = key + ':result'
+        lock_key = key + ':lock'
+        deadline = time.time() + self.lock_timeout
+
+        while True:
+            cached = cache.get(result_key)
+            if cached is not None:
+                return cached[0]
+            if cache.add(lock_key, 1, self.lock_timeout):
+                try:
+                    result = func()
+                    # Wrapped to distinguish `None` result from a cache miss
+                    cache.set(result_key, (result,), self.result_timeout)
+                    return result
+                finally:
+                    cache.delete(lock_key)
+            if time.time() > deadline:
+                return func()
+            time.sleep(self.poll_interval)
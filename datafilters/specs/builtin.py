@@ -7,6 +7,13 @@ import warnings
 from django.utils.translation import ugettext_lazy as _
 from django import forms
 
+from django.db import connections
+from django.db.models import Count
+from django.db.models.sql.constants import LOOKUP_SEP
+
+from datafilters.cache import describe_queryset, get_filter_cache, \
+    make_key, track_model_version
+from datafilters.fields import CachedModelChoiceField, RangeField
 from datafilters.filterspec import FilterSpec
 
 __all__ = (
@@ -17,6 +24,8 @@ __all__ = (
     'GenericSpec',
     'GreaterThanFilterSpec',
     'GreaterThanZeroFilterSpec',
+    'ModelChoiceFilterSpec',
+    'RangeFilterSpec',
     'SelectBoolFilterSpec',
 )
 
@@ -84,6 +93,9 @@ class DateFieldFilterSpec(FilterSpec):
 
         return self.filter_choices[picked_choice](today, tomorrow)
 
+    def get_index_choices(self):
+        return ('today', 'this_week', 'this_month', 'this_year')
+
 
 class DatePickFilterSpec(FilterSpec):
 
@@ -149,6 +161,9 @@ class SelectBoolFilterSpec(FilterSpec):
         else:
             return {self.field_name: not checked}
 
+    def get_index_choices(self):
+        return ('true', 'false')
+
 
 class GreaterThanFilterSpec(SelectBoolFilterSpec):
 
@@ -176,3 +191,154 @@ class GreaterThanFilterSpec(SelectBoolFilterSpec):
 
 # For backward compatibility
 GreaterThanZeroFilterSpec = GreaterThanFilterSpec
+
+
+class ModelChoiceFilterSpec(FilterSpec):
+    '''
+    Filter by a related object picked from `queryset`.
+
+    Choices are loaded lazily and cached across requests for `timeout`
+    seconds (see `datafilters.fields.CachedModelChoiceField`); they are
+    invalidated on changes of the queryset's model.
+    '''
+
+    field_cls = CachedModelChoiceField
+
+    def __init__(self, field_name, queryset, label=None, **field_kwargs):
+        field_kwargs['label'] = label
+        field_kwargs['queryset'] = queryset
+        super(ModelChoiceFilterSpec, self).__init__(field_name, **field_kwargs)
+        track_model_version(queryset.model)
+
+    def to_lookup(self, pk):
+        if pk is None:
+            return {}
+        return {self.field_name: pk}
+
+
+def bucket_sql(column, vendor):
+    '''
+    Return SQL of index of the bucket containing value of `column` (params
+    are origin and size of buckets, repeated for each occurrence).
+    '''
+    quotient = '((%s - %%s) * 1.0 / %%s)' % column
+    if vendor == 'sqlite':
+        # SQLite may be built without FLOOR
+        return ('(CASE WHEN %(q)s < CAST(%(q)s AS INTEGER) '
+                'THEN CAST(%(q)s AS INTEGER) - 1 '
+                'ELSE CAST(%(q)s AS INTEGER) END)' % {'q': quotient})
+    return 'FLOOR(%s)' % quotient
+
+
+class RangeFilterSpec(FilterSpec):
+    '''
+    Filter by a numeric range: minimum (inclusive) and maximum (exclusive),
+    both optional. Values are cleaned with `base_field` form field class
+    (`DecimalField` by default).
+
+    `histogram` returns counts of rows per bucket of the field under the
+    other active filters, e.g. for range sliders.
+    '''
+
+    field_cls = RangeField
+    histogram_timeout = 300
+
+    def __init__(self, field_name, label=None, histogram_timeout=None,
+            **field_kwargs):
+        field_kwargs['label'] = label
+        super(RangeFilterSpec, self).__init__(field_name, **field_kwargs)
+        if histogram_timeout is not None:
+            self.histogram_timeout = histogram_timeout
+
+    def to_lookup(self, value_range):
+        if not value_range:
+            return {}
+        minimum, maximum = value_range
+        lookup = {}
+        if minimum is not None:
+            lookup['%s__gte' % self.field_name] = minimum
+        if maximum is not None:
+            lookup['%s__lt' % self.field_name] = maximum
+        return lookup
+
+    def get_name(self, filterform):
+        # Specs of a form are copies with the same creation counter
+        for name, spec in filterform.filter_specs.items():
+            if spec.creation_counter == self.creation_counter:
+                return name
+        raise ValueError('Spec is not a part of %s'
+                         % filterform.__class__.__name__)
+
+    def histogram(self, filterform, queryset, bucket_size, bounds=None):
+        '''
+        Return list of (lower bound, count) pairs for buckets of
+        `bucket_size` with rows of `queryset` filtered by the other active
+        specs of `filterform`. Buckets start at `bounds[0]` and end before
+        `bounds[1]` (both default to the range of the data).
+
+        Counts are computed in one grouped query and cached for
+        `histogram_timeout` seconds.
+        '''
+        queryset = filterform.filter_without(queryset,
+                                             self.get_name(filterform))
+        field_name = self.field_name
+        lookup = {'%s__isnull' % field_name: False}
+        if bounds is not None:
+            lookup['%s__gte' % field_name] = bounds[0]
+            lookup['%s__lt' % field_name] = bounds[1]
+        queryset = queryset.filter(**lookup)
+
+        # Rows are grouped by index of their bucket, counted from `origin`
+        query = queryset.query
+        _field, target, _opts, joins, _last, _extra = query.setup_joins(
+            field_name.split(LOOKUP_SEP), query.get_meta(),
+            query.get_initial_alias(), False)
+        connection = connections[queryset.db]
+        qn = connection.ops.quote_name
+        sql = bucket_sql('%s.%s' % (qn(joins[-1]), qn(target.column)),
+                         connection.vendor)
+        origin = bounds[0] if bounds is not None else 0
+        counts = queryset.extra(
+            select={'datafilters_bucket': sql},
+            select_params=(origin, bucket_size) * (sql.count('%s') // 2)) \
+            .values('datafilters_bucket') \
+            .annotate(datafilters_count=Count('pk', distinct=True)) \
+            .order_by()
+
+        cache = get_filter_cache()
+        key = make_key('histogram', describe_queryset(counts), bucket_size,
+                       bounds)
+        histogram = cache.get(key)
+        if histogram is None:
+            histogram = self.make_buckets(
+                [(row['datafilters_bucket'], row['datafilters_count'])
+                 for row in counts],
+                bucket_size, bounds)
+            cache.set(key, histogram, self.histogram_timeout)
+        return histogram
+
+    def make_buckets(self, bucket_counts, bucket_size, bounds=None):
+        '''
+        Return list of (lower bound, count) pairs from (bucket index, count)
+        pairs. Indexes are counted from `bounds[0]` or 0.
+        '''
+        if bounds is not None:
+            origin, end = bounds
+            first = 0
+            nbuckets = int((end - origin) // bucket_size)
+            if origin + nbuckets * bucket_size < end:
+                nbuckets += 1
+        elif bucket_counts:
+            origin = 0
+            indexes = [int(index) for index, _count in bucket_counts]
+            first = min(indexes)
+            nbuckets = max(indexes) - first + 1
+        else:
+            return []
+        counts = [0] * nbuckets
+        for index, count in bucket_counts:
+            i = int(index) - first
+            if 0 <= i < nbuckets:
+                counts[i] += count
+        return [(origin + (first + i) * bucket_size, count)
+                for i, count in enumerate(counts)]
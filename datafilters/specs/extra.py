@@ -52,6 +52,9 @@ class IsNullFilterSpec(FilterSpec):
         else:
             return {self.lookup: checked}
 
+    def get_index_choices(self):
+        return (True, False)
+
 
 class InFilterSpec(FilterSpec):
 
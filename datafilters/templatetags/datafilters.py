@@ -1,5 +1,13 @@
+from __future__ import absolute_import
+
 import itertools
 from django import template
+from django.template.loader import render_to_string
+from django.utils import translation
+from django.utils.safestring import mark_safe
+
+from datafilters.cache import get_filter_cache, get_form_data, make_key
+from datafilters.fields import LazyModelChoices
 
 register = template.Library()
 
@@ -25,3 +33,55 @@ def split_in_columns(filterform, fields_per_column=None):
 
     for _i in range(ncolumns):
         yield itertools.islice(itr, fields_per_column)
+
+
+def get_columns_cache_key(filterform, fields_per_column, template_name):
+    cls = type(filterform)
+    choices_keys = [field.choices.get_cache_key()
+                    for field in filterform.fields.values()
+                    if isinstance(getattr(field, 'choices', None),
+                                  LazyModelChoices)]
+    return make_key('columns',
+                    '%s.%s' % (cls.__module__, cls.__name__),
+                    filterform.prefix,
+                    filterform.is_bound,
+                    get_form_data(filterform),
+                    fields_per_column,
+                    template_name,
+                    translation.get_language(),
+                    choices_keys)
+
+
+@register.simple_tag
+def filterform_columns(filterform, fields_per_column=None, timeout=None,
+        template_name='datafilters/filterform_columns.html'):
+    '''
+    Render filter form split in columns (see `split_in_columns`) and cache
+    the HTML.
+
+    Cache key is built from the form class, normalized data (initial
+    values of unbound forms), `fields_per_column`, current language and
+    versions of cached model choices, so the HTML is rendered once per
+    distinct filter state::
+
+        {% filterform_columns filterform 3 timeout=600 %}
+
+    Forms with errors are rendered without caching.
+    '''
+    if fields_per_column is None:
+        fields_per_column = filterform.fields_per_column
+
+    context = {
+        'filterform': filterform,
+        'fields_per_column': fields_per_column,
+    }
+    if filterform.errors:
+        return mark_safe(render_to_string(template_name, context))
+
+    cache = get_filter_cache()
+    key = get_columns_cache_key(filterform, fields_per_column, template_name)
+    html = cache.get(key)
+    if html is None:
+        html = render_to_string(template_name, context)
+        cache.set(key, html, timeout)
+    return mark_safe(html)
@@ -1 +1,6 @@
 from datafilters.tests.specs_builtin import *
+from datafilters.tests.template_tags import *
+from datafilters.tests.guard import *
+from datafilters.tests.singleflight import *
+from datafilters.tests.extra_lookup import *
+from datafilters.tests.concurrency import *
@@ -0,0 +1,103 @@
+import threading
+import time
+
+from django.db import DatabaseError
+from django.test import TestCase
+
+from datafilters.concurrency import ConcurrencyTimeout, \
+    prefetch_iterators, run_concurrently, run_queries
+
+
+class RunConcurrentlyTestCase(TestCase):
+
+    def test_results_in_order(self):
+        funcs = [lambda i=i: i * 2 for i in range(5)]
+        self.assertEqual(run_concurrently(funcs, max_workers=2),
+                         [0, 2, 4, 6, 8])
+
+    def test_parallel(self):
+        # Both functions wait for each other, so they must run in parallel
+        barrier = [threading.Event(), threading.Event()]
+
+        def make_func(i):
+            def func():
+                barrier[i].set()
+                return barrier[1 - i].wait(1) or False
+            return func
+
+        self.assertEqual(run_concurrently([make_func(0), make_func(1)]),
+                         [True, True])
+
+    def test_error(self):
+        def fail():
+            raise ValueError('boom')
+
+        self.assertRaises(ValueError, run_concurrently,
+                          [lambda: 1, fail])
+
+    def test_timeout(self):
+        self.assertRaises(ConcurrencyTimeout, run_concurrently,
+                          [lambda: time.sleep(0.5), lambda: 1], timeout=0.05)
+
+
+class RunQueriesTestCase(TestCase):
+
+    def test_timeout(self):
+        calls = []
+
+        def slow():
+            calls.append('slow')
+            time.sleep(0.2)
+
+        def fast():
+            calls.append('fast')
+
+        # Queries are not run again after the timeout
+        self.assertRaises(ConcurrencyTimeout, run_queries, [slow, fast], [],
+                          timeout=0.05)
+        self.assertEqual(sorted(calls), ['fast', 'slow'])
+
+    def test_database_error(self):
+        calls = []
+
+        def flaky():
+            calls.append('flaky')
+            if threading.current_thread().name.startswith('datafilters-'):
+                raise DatabaseError('too many connections')
+            return 1
+
+        def stable():
+            calls.append('stable')
+            return 2
+
+        # Only the failed query is repeated
+        self.assertEqual(run_queries([flaky, stable], []), [1, 2])
+        self.assertEqual(sorted(calls), ['flaky', 'flaky', 'stable'])
+
+
+class PrefetchIteratorsTestCase(TestCase):
+
+    def test_items(self):
+        produced = []
+
+        def numbers():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        first, second = prefetch_iterators([numbers, lambda: iter('ab')],
+                                           prefetch=2)
+        self.assertEqual(list(second), ['a', 'b'])
+        time.sleep(0.1)
+        # Reading ahead is bounded (by the queue and one pending item)
+        self.assertTrue(len(produced) <= 3)
+        self.assertEqual(list(first), range(10))
+
+    def test_error(self):
+        def fail():
+            yield 1
+            raise ValueError('boom')
+
+        iterator, = prefetch_iterators([fail])
+        self.assertEqual(next(iterator), 1)
+        self.assertRaises(ValueError, next, iterator)
@@ -0,0 +1,44 @@
+from django.test import TestCase
+
+from datafilters.extra_lookup import Condition, Extra
+
+
+class ExtraTestCase(TestCase):
+
+    def test_empty(self):
+        self.assertFalse(Extra())
+        self.assertTrue(Extra(tables=['foo']))
+        self.assertTrue(Extra(conditions=[Condition('foo', '{column} > 1')]))
+
+    def test_merge(self):
+        extra = Extra()
+        extra += Extra(where=['foo.a = %s'], params=[1], tables=['foo'])
+        extra += Extra(where=['foo.a = %s'], params=[1], tables=['foo'])
+        extra += Extra(where=['foo.a = %s'], params=[2], tables=['foo', 'bar'])
+        extra += Extra(conditions=[Condition('b', '{column} > %s', [0])])
+        extra += Extra(conditions=[Condition('b', '{column} > %s', [0])])
+
+        self.assertEqual(extra.as_kwargs(), {
+            'where': ['foo.a = %s', 'foo.a = %s'],
+            'params': [1, 2],
+            'tables': ['foo', 'bar'],
+        })
+        self.assertEqual(len(extra.conditions), 1)
+
+    def test_where_list(self):
+        extra = Extra(where=['foo.a = %s'], params=[1])
+        extra.where.append('foo.b IS NULL')
+        extra.where.append('foo.c = %s')
+        extra.params.append(3)
+        self.assertEqual(extra.where_groups, [
+            (('foo.a = %s',), (1,)),
+            (('foo.b IS NULL', 'foo.c = %s'), (3,)),
+        ])
+
+        merged = Extra(where=['foo.a = %s'], params=[1])
+        merged += extra
+        self.assertEqual(merged.as_kwargs(), {
+            'where': ['foo.a = %s', 'foo.b IS NULL', 'foo.c = %s'],
+            'params': [1, 3],
+            'tables': [],
+        })
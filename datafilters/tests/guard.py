@@ -0,0 +1,61 @@
+from django.db import connection
+from django.test import TestCase
+
+from datafilters.filterform import FilterForm
+from datafilters.guard import QueryTimeout, statement_timeout
+from datafilters.specs import builtin
+
+
+class CostForm(FilterForm):
+    max_cost = 3
+
+    text = builtin.ContainsFilterSpec('text', cost=2)
+    other_text = builtin.ContainsFilterSpec('other_text', cost=2)
+    flag = builtin.SelectBoolFilterSpec('flag')
+
+
+class CostPolicyTestCase(TestCase):
+
+    def test_within_budget(self):
+        form = CostForm({'text': 'a', 'flag': 'true'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.total_cost, 3)
+
+        # Inactive specs cost nothing
+        form = CostForm({'text': 'a', 'other_text': '', 'flag': 'all'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.total_cost, 2)
+
+    def test_over_budget(self):
+        form = CostForm({'text': 'a', 'other_text': 'b'})
+        self.assertFalse(form.is_valid())
+        self.assertTrue(form.non_field_errors())
+        self.assertEqual(form.get_lookup_args(), ((), {}))
+        self.assertTrue(form.over_budget)
+
+        # Invalid values don't make the form over budget
+        form = CostForm({'flag': 'maybe'})
+        self.assertFalse(form.is_valid())
+        self.assertFalse(form.over_budget)
+
+
+class StatementTimeoutTestCase(TestCase):
+
+    slow_query = ('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                  'SELECT i + 1 FROM n) SELECT max(i) FROM n')
+
+    def test_timeout(self):
+        cursor = connection.cursor()
+        with self.assertRaises(QueryTimeout):
+            with statement_timeout(50):
+                cursor.execute(self.slow_query)
+
+        # Timeout is reset after the block
+        with statement_timeout(50):
+            cursor.execute('SELECT 1')
+        cursor.execute('SELECT 1')
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_disabled(self):
+        with statement_timeout(None):
+            connection.cursor().execute('SELECT 1')
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from django.test import TestCase
+
+from datafilters.singleflight import CacheSingleFlight, SingleFlight
+
+
+class SingleFlightTestMixin(object):
+
+    flight_cls = None
+    flight_kwargs = {}
+
+    def get_flight(self):
+        return self.flight_cls(**self.flight_kwargs)
+
+    def run_concurrently(self, flight, key, func, nthreads=5):
+        results = []
+
+        def worker():
+            results.append(flight.do(key, func))
+
+        threads = [threading.Thread(target=worker) for _i in range(nthreads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_coalesce(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return {'count': 42}
+
+        results = self.run_concurrently(self.get_flight(), self.key, compute)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'count': 42}] * 5)
+
+
+class SingleFlightTestCase(SingleFlightTestMixin, TestCase):
+
+    key = 'local'
+    flight_cls = SingleFlight
+
+    def test_sequential(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do('a', lambda: 1), 1)
+        self.assertEqual(flight.do('a', lambda: 2), 2)
+
+    def test_error(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError('boom')
+
+        self.assertRaises(ValueError, flight.do, 'a', fail)
+        self.assertEqual(flight.calls, {})
+
+
+class CacheSingleFlightTestCase(SingleFlightTestMixin, TestCase):
+
+    key = 'datafilters:test:shared'
+    flight_cls = CacheSingleFlight
+    flight_kwargs = {'result_timeout': 1}
+
+    def test_result_shared_between_groups(self):
+        # Groups stand for different processes
+        self.get_flight().do('datafilters:test:groups', lambda: None)
+        calls = []
+        result = self.get_flight().do('datafilters:test:groups',
+                                      lambda: calls.append(1))
+        self.assertEqual(result, None)
+        self.assertEqual(calls, [])
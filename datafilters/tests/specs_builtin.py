@@ -1,4 +1,5 @@
 import datetime
+from decimal import Decimal
 
 from django.test import TestCase
 from django import forms
@@ -208,3 +209,36 @@ class GreaterThanZeroTestCase(FilterSpecTestMixin, TestCase):
         ('false', {'foo__lte': 0}),
         ('all', {}),
     ]
+
+
+class RangeTestCase(FilterSpecTestMixin, TestCase):
+
+    spec_cls = builtin.RangeFilterSpec
+
+    test_patterns = [
+        ((1, 5), {'foo__gte': 1, 'foo__lt': 5}),
+        ((None, 5), {'foo__lt': 5}),
+        ((1, None), {'foo__gte': 1}),
+    ]
+
+    def test_field(self):
+        class Form(FilterForm):
+            foo = self.get_spec()
+
+        f = Form({'foo_0': '1.5', 'foo_1': '10'})
+        self.assertTrue(f.is_valid())
+        self.assertEqual(f.get_lookup_args()[1],
+                         {'foo__gte': Decimal('1.5'), 'foo__lt': 10})
+        self.assertFalse(Form({'foo_0': '10', 'foo_1': '1'}).is_valid())
+        self.assertFalse(Form({'foo_0': 'x'}).is_valid())
+
+    def test_buckets(self):
+        spec = self.get_spec()
+        self.assertEqual(spec.make_buckets([(1, 1), (2, 2), (-1, 1)], 10),
+                         [(-10, 1), (0, 0), (10, 1), (20, 2)])
+        self.assertEqual(spec.make_buckets([(1, 1), (2, 2)], 10, (0, 20)),
+                         [(0, 0), (10, 1)])
+        self.assertEqual(spec.make_buckets(
+            [(Decimal('-1'), 1), (Decimal('1'), 3)], Decimal('0.5')),
+            [(Decimal('-0.5'), 1), (0, 0), (Decimal('0.5'), 3)])
+        self.assertEqual(spec.make_buckets([], 10), [])
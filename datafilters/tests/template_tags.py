@@ -0,0 +1,65 @@
+from django.template import Context, Template
+from django.test import TestCase
+
+from datafilters.cache import get_filter_cache
+from datafilters.filterform import FilterForm
+from datafilters.specs import builtin
+from datafilters.templatetags.datafilters import get_columns_cache_key
+
+
+class ColumnsForm(FilterForm):
+    fields_per_column = 2
+
+    text = builtin.ContainsFilterSpec('text', label='Text')
+    flag = builtin.SelectBoolFilterSpec('flag', label='Flag')
+    date = builtin.DateFieldFilterSpec('date', label='Date')
+
+
+class FilterFormColumnsTestCase(TestCase):
+
+    template = Template(
+        '{% load datafilters %}{% filterform_columns filterform %}')
+
+    def render(self, form):
+        return self.template.render(Context({'filterform': form}))
+
+    def test_render(self):
+        html = self.render(ColumnsForm({'text': 'abc'}))
+        self.assertEqual(html.count('class="filterform-column"'), 2)
+        self.assertIn('value="abc"', html)
+
+    def test_cached(self):
+        form = ColumnsForm({'text': 'cached', 'flag': 'all'})
+        key = get_columns_cache_key(form, 2,
+                                    'datafilters/filterform_columns.html')
+        html = self.render(form)
+        self.assertEqual(get_filter_cache().get(key), html)
+
+        # Parameters outside of the form don't matter
+        same_form = ColumnsForm({'flag': 'all', 'text': 'cached', 'page': 2})
+        self.assertEqual(key, get_columns_cache_key(
+            same_form, 2, 'datafilters/filterform_columns.html'))
+
+        other_form = ColumnsForm({'text': 'other'})
+        self.assertNotEqual(key, get_columns_cache_key(
+            other_form, 2, 'datafilters/filterform_columns.html'))
+
+        # Unbound forms render initial values
+        self.assertNotEqual(get_columns_cache_key(
+            ColumnsForm({}), 2, 'datafilters/filterform_columns.html'),
+            get_columns_cache_key(
+            ColumnsForm(), 2, 'datafilters/filterform_columns.html'))
+
+    def test_initial(self):
+        html = self.render(ColumnsForm(initial={'text': 'foo'}))
+        self.assertIn('value="foo"', html)
+        html = self.render(ColumnsForm(initial={'text': 'bar'}))
+        self.assertIn('value="bar"', html)
+
+    def test_errors_not_cached(self):
+        form = ColumnsForm({'date': 'yesterday-ish'})
+        key = get_columns_cache_key(form, 2,
+                                    'datafilters/filterform_columns.html')
+        self.render(form)
+        self.assertTrue(form.errors)
+        self.assertEqual(get_filter_cache().get(key), None)
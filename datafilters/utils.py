@@ -0,0 +1,36 @@
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.sql.constants import LOOKUP_SEP
+from django.utils.importlib import import_module
+
+__all__ = ('spans_multivalued_relation', 'import_by_path')
+
+
+def spans_multivalued_relation(model, lookup):
+    '''
+    Return `True` if lookup (e.g. 'choice__votes__gt') traverses a reverse
+    foreign key or a many-to-many relation of `model`.
+
+    Conditions on such relations are not independent: two of them in one
+    `filter` call must hold for the same related row.
+    '''
+    opts = model._meta
+    for part in lookup.split(LOOKUP_SEP):
+        try:
+            field, _model, direct, m2m = opts.get_field_by_name(part)
+        except FieldDoesNotExist:
+            return False
+        if m2m or not direct:
+            return True
+        rel = getattr(field, 'rel', None)
+        if rel is None:
+            return False
+        opts = rel.to._meta
+    return False
+
+
+def import_by_path(dotted_path):
+    '''
+    Import and return an object by its dotted path ('module.name').
+    '''
+    module_path, name = dotted_path.rsplit('.', 1)
+    return getattr(import_module(module_path), name)
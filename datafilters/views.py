@@ -1,5 +1,18 @@
+from calendar import timegm
+
+from django.db.models import Count, Max
+from django.http import HttpResponseNotModified
+from django.utils import translation
+from django.utils.decorators import classonlymethod
+from django.utils.http import http_date, parse_etags, \
+    parse_http_date_safe, quote_etag
 from django.views.generic.list import MultipleObjectMixin
 
+from datafilters.cache import get_model_version, make_key, \
+    track_model_version
+from datafilters.guard import QueryTimeout
+from datafilters.routing import ReplicaFallback, route_queryset
+
 __all__ = ('FilterFormMixin',)
 
 
@@ -10,14 +23,119 @@ class FilterFormMixin(MultipleObjectMixin):
     filter_form_cls = None
     use_filter_chaining = False
     context_filterform_name = 'filterform'
+    # Database alias for filtered queries, defaults to one set on the form
+    # (see `datafilters.routing`)
+    read_database = None
+    replication_lag = None
+    # Conditional GET: a field with modification time of objects (validator
+    # is its maximum and number of filtered objects) and/or models whose
+    # changes are counted (see `datafilters.cache.track_model_version`)
+    last_modified_field = None
+    version_models = None
+    # `datafilters.refinement.RefinementCache` to reuse results of recent
+    # filters
+    refinement_cache = None
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        # Versions of models are tracked once, when URLs are loaded
+        version_models = initkwargs.get('version_models', cls.version_models)
+        for model in version_models or ():
+            track_model_version(model)
+        return super(FilterFormMixin, cls).as_view(**initkwargs)
+
+    def get(self, request, *args, **kwargs):
+        """
+        Answer `304 Not Modified` if validators of the filtered object list
+        match request headers, before any objects are fetched.
+        """
+        validators = self.get_validators()
+        if validators is None:
+            return super(FilterFormMixin, self).get(request, *args, **kwargs)
+
+        etag, last_modified = validators
+        if self.is_not_modified(request, etag, last_modified):
+            response = HttpResponseNotModified()
+        else:
+            response = super(FilterFormMixin, self).get(request, *args,
+                                                        **kwargs)
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def get_validators(self):
+        """
+        Return (ETag, last modification timestamp or `None`) of the filtered
+        object list or `None` if conditional GET is not configured.
+        """
+        if not self.last_modified_field and not self.version_models:
+            return None
+
+        parts = [self.request.get_full_path(), translation.get_language()]
+        user = getattr(self.request, 'user', None)
+        if user is not None and user.is_authenticated():
+            parts.append(user.pk)
+
+        for model in self.version_models or ():
+            parts.append(get_model_version(model))
+
+        last_modified = None
+        if self.last_modified_field:
+            stats = self.get_replica_fallback().read(
+                lambda qs: qs.aggregate(
+                    last_modified=Max(self.last_modified_field),
+                    count=Count('pk', distinct=True)),
+                self.get_queryset())
+            parts.append(stats['count'])
+            if stats['last_modified'] is not None:
+                last_modified = timegm(stats['last_modified'].utctimetuple())
+                parts.append(last_modified)
+
+        return quote_etag(make_key('etag', *parts)), last_modified
+
+    def is_not_modified(self, request, etag, last_modified):
+        if request.method not in ('GET', 'HEAD'):
+            return False
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since:
+            if_modified_since = parse_http_date_safe(if_modified_since)
+
+        if if_none_match:
+            try:
+                etags = parse_etags(if_none_match)
+            except ValueError:
+                return False
+            if etag.strip('"') not in etags and '*' not in etags:
+                return False
+            return (not if_modified_since or
+                    (last_modified is not None and
+                     last_modified <= if_modified_since))
+        return (if_modified_since is not None and last_modified is not None
+                and last_modified <= if_modified_since)
 
     def get_filter(self):
         """
         Get FilterForm instance.
+
+        The form is constructed once per request.
         """
-        return self.filter_form_cls(self.request.GET,
-                                    runtime_context=self.get_runtime_context(),
-                                    use_filter_chaining=self.use_filter_chaining)
+        if getattr(self, '_filter_form', None) is None:
+            self._filter_form = self.filter_form_cls(self.request.GET,
+                    runtime_context=self.get_runtime_context(),
+                    use_filter_chaining=self.use_filter_chaining)
+        return self._filter_form
+
+    def get_replica_fallback(self):
+        """
+        Get `datafilters.routing.ReplicaFallback` for reads of the request.
+        """
+        if getattr(self, '_replica_fallback', None) is None:
+            qs = super(FilterFormMixin, self).get_queryset()
+            self._replica_fallback = ReplicaFallback(qs.db)
+        return self._replica_fallback
 
     def get_queryset(self):
         """
@@ -26,20 +144,56 @@ class FilterFormMixin(MultipleObjectMixin):
         """
         qs = super(FilterFormMixin, self).get_queryset()
         filter_form = self.get_filter()
+        fallback = self.get_replica_fallback()
+        qs = fallback.using(route_queryset(
+            self.request, qs,
+            self.read_database or filter_form.read_database,
+            self.replication_lag))
         if filter_form.is_valid():
-            qs = filter_form.filter(qs).distinct()
-        return qs
+            if self.refinement_cache is not None:
+                qs = fallback.read(
+                    lambda qs: self.refinement_cache.filter(
+                        self.request, filter_form, qs),
+                    qs)
+            else:
+                qs = filter_form.filter(qs).distinct()
+        elif filter_form.over_budget:
+            qs = qs.none()
+        return filter_form.apply_query_hints(qs)
 
     def get_context_data(self, **kwargs):
         """
         Add filter form to the context.
 
-        TODO: Currently we construct the filter form object twice - in
-        get_queryset and here, in get_context_data. Will need to figure out a
-        good way to eliminate extra initialization.
+        If objects are read from a replica or the form has
+        `statement_timeout`, the object list (or the page) is fetched here,
+        with fallback to the primary database and under the timeout.
+        Queries aborted by the timeout give empty object list and an error
+        in the form.
         """
-        context = super(FilterFormMixin, self).get_context_data(**kwargs)
-        context[self.context_filterform_name] = self.get_filter()
+        filter_form = self.get_filter()
+        fallback = self.get_replica_fallback()
+        object_list = kwargs.get('object_list', self.object_list)
+        if (object_list.db == fallback.primary and
+                filter_form.statement_timeout is None):
+            context = super(FilterFormMixin, self).get_context_data(**kwargs)
+        else:
+            def fetch(object_list):
+                kwargs['object_list'] = self.object_list = object_list
+                with filter_form.query_guard(object_list.db):
+                    context = super(FilterFormMixin, self).get_context_data(
+                        **kwargs)
+                    len(context['object_list'])
+                return context
+
+            try:
+                context = fallback.read(fetch, object_list)
+            except QueryTimeout:
+                filter_form.handle_timeout()
+                kwargs['object_list'] = self.object_list = object_list.none()
+                context = super(FilterFormMixin, self).get_context_data(
+                    **kwargs)
+        context[self.context_filterform_name] = filter_form
         return context
 
     def get_runtime_context(self):
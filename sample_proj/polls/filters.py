@@ -2,7 +2,9 @@ from datafilters.filterform import FilterForm
 from datafilters.filterspec import FilterSpec
 from datafilters.specs import (DateFieldFilterSpec,
     GreaterThanFilterSpec, ContainsFilterSpec,
-    GreaterThanZeroFilterSpec)
+    GreaterThanZeroFilterSpec, ModelChoiceFilterSpec)
+
+from polls.models import Poll
 
 
 class PollsFilterForm(FilterForm):
@@ -12,3 +14,9 @@ class PollsFilterForm(FilterForm):
     has_major_choice = GreaterThanFilterSpec('choice__votes', value=50)
     question_contains = ContainsFilterSpec('question')
     choice_contains = ContainsFilterSpec('choice__choice_text')
+
+
+class ChoicesFilterForm(FilterForm):
+    poll = ModelChoiceFilterSpec('poll', queryset=Poll.objects.all(),
+                                 label_from_instance=lambda p: p.question)
+    text_contains = ContainsFilterSpec('choice_text')
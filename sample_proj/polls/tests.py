@@ -1,4 +1,51 @@
+import copy
+import datetime
+import os
+import pickle
+import tempfile
+import time
+from StringIO import StringIO
+
+from django import forms
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connections
+from django.db.models import Avg, Count, Max, Sum, signals
+from django.db.models.query import QuerySet
+from django.contrib.auth.models import AnonymousUser
+from django.forms.forms import NON_FIELD_ERRORS
+from django.http import QueryDict
 from django.test import TestCase
+from django.template.response import TemplateResponse
+from django.test.client import RequestFactory
+
+from datafilters.aggregates import AggregateCache
+from datafilters.analytics import FilterStatsCollector, SQLiteStatsStorage, \
+    fingerprint
+from datafilters import bitmap_index
+from datafilters.batch import match_filters
+from datafilters.bitmap_index import BitmapIndex, CacheIndexStorage, \
+    FileIndexStorage
+from datafilters.cache import get_filter_cache
+from datafilters.concurrency import can_run_concurrently
+from datafilters.decorators import filter_powered
+from datafilters.extra_lookup import Condition, Extra
+from datafilters.fastparse import FilterParser
+from datafilters.management.commands import rebuild_filter_index, \
+    warm_filter_cache
+from datafilters.filterform import FilterForm
+from datafilters.filterspec import FilterSpec
+from datafilters.specs import ContainsFilterSpec, RangeFilterSpec
+from datafilters.singleflight import SingleFlight
+from datafilters.refinement import RefinementCache
+from datafilters.results import FilterResultCache
+from datafilters.routing import get_read_database, mark_write
+from datafilters.sharding import ShardedQuerySet
+
+from polls.filters import PollsFilterForm, ChoicesFilterForm
+from polls.models import Poll, Choice
+from polls.views import PollListView
 
 
 class FilterViewTestCase(TestCase):
@@ -49,3 +96,1040 @@ class FilterViewTestCase(TestCase):
     def test_mixin_chaining(self):
         self._test_common('/polls/classbased_chaining/')
         self._test_chaining('/polls/classbased_chaining/')
+
+
+class BitmapIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.index = BitmapIndex('test_polls', Poll.objects.all(),
+                                 PollsFilterForm,
+                                 storage=FileIndexStorage(self.get_path()))
+        self.index.rebuild()
+
+    def tearDown(self):
+        for path in (self.path, self.path + '.lock'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get_path(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.path)
+        return self.path
+
+    def test_match(self):
+        form = PollsFilterForm({'has_major_choice': 'true'})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.index.match(form), [1, 3])
+
+        form = PollsFilterForm({'has_major_choice': 'false',
+                                'has_choice_with_votes': 'true'},
+                               use_filter_chaining=True)
+        self.assertEqual(self.index.match(form), [1, 2, 3])
+
+    def test_not_indexed(self):
+        form = PollsFilterForm({'question_contains': 'framework'})
+        self.assertEqual(self.index.match(form), None)
+        self.assertEqual(list(self.index.filter(form, Poll.objects.all())),
+                         [Poll.objects.get(pk=3)])
+
+    def test_bulk_multivalued(self):
+        # Two specs over `choice__votes` must hold for the same choice
+        form = PollsFilterForm({'has_major_choice': 'true',
+                                'has_choice_with_votes': 'false'})
+        self.assertEqual(self.index.match(form), None)
+
+    def test_incremental(self):
+        self.index.connect()
+        try:
+            poll = Poll.objects.create(question='New?',
+                                       pub_date=datetime.datetime.now())
+            form = PollsFilterForm({'pub_date': 'today'})
+            self.assertEqual(self.index.match(form), [poll.pk])
+            poll.delete()
+            self.assertEqual(self.index.match(form), [])
+        finally:
+            signals.post_save.disconnect(dispatch_uid='datafilters-index-test_polls',
+                                         sender=Poll)
+            signals.post_delete.disconnect(dispatch_uid='datafilters-index-test_polls',
+                                           sender=Poll)
+
+    def test_update_in_one_query(self):
+        poll = Poll.objects.create(question='New?',
+                                   pub_date=datetime.datetime.now())
+        with self.assertNumQueries(1):
+            self.index.update_instance(poll)
+        form = PollsFilterForm({'pub_date': 'today'})
+        self.assertEqual(self.index.match(form), [poll.pk])
+
+    def test_locked_update(self):
+        get_filter_cache().clear()
+        index = BitmapIndex('test_polls_cache', Poll.objects.all(),
+                            PollsFilterForm,
+                            storage=CacheIndexStorage(lock_timeout=0))
+        index.rebuild()
+        form = PollsFilterForm({'has_major_choice': 'true'})
+        self.assertEqual(index.match(form), [1, 3])
+
+        # Another process is updating the index
+        get_filter_cache().add('datafilters:index-lock:test_polls_cache', 1)
+        index.update_instance(Poll.objects.get(pk=2))
+        self.assertEqual(index.match(form), None)
+
+    def test_rebuild_command(self):
+        command = rebuild_filter_index.Command()
+        self.assertRaises(CommandError, command.handle, 'polls.no_such_index')
+        registered = dict(bitmap_index.registry)
+        bitmap_index.registry.clear()
+        try:
+            self.assertRaises(CommandError, command.handle)
+        finally:
+            bitmap_index.registry.update(registered)
+
+
+class ModelChoiceFilterSpecTestCase(TestCase):
+
+    def test_filter_without_choices(self):
+        form = ChoicesFilterForm({'poll': '3'})
+        with self.assertNumQueries(0):
+            self.assertTrue(form.is_valid())
+        self.assertEqual(form.filter(Choice.objects.all()).count(), 4)
+
+        self.assertFalse(ChoicesFilterForm({'poll': 'x'}).is_valid())
+
+    def test_cached_choices(self):
+        ChoicesFilterForm()['poll'].as_widget()
+        with self.assertNumQueries(0):
+            html = ChoicesFilterForm()['poll'].as_widget()
+        self.assertIn('What&#39;s new?', html)
+
+        Poll.objects.create(question='Brand new?',
+                            pub_date=datetime.datetime.now())
+        with self.assertNumQueries(1):
+            html = ChoicesFilterForm()['poll'].as_widget()
+        self.assertIn('Brand new?', html)
+
+
+class ReadReplicaTestCase(TestCase):
+
+    multi_db = True
+
+    def setUp(self):
+        # Replica lags behind: the poll exists on primary only
+        Poll.objects.create(question='Not replicated yet?',
+                            pub_date=datetime.datetime.now())
+
+    def test_views(self):
+        response = self.client.get('/polls/classbased/')
+        self.assertEqual(len(response.context_data['polls']), 4)
+
+        for url in ('/polls/classbased_replica/', '/polls/decorated_replica/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            polls = response.context_data['polls']
+            self.assertEqual(polls.db, 'replica')
+            self.assertEqual(len(polls), 3)
+
+        response = self.client.get('/polls/decorated_replica/')
+        self.assertEqual(response.context_data['polls_count'], 3)
+
+    def test_fallback(self):
+        class Request(object):
+            session = {}
+
+        request = Request()
+        self.assertEqual(get_read_database(request, 'replica'), 'replica')
+        self.assertEqual(get_read_database(request, 'no_such_db'), None)
+
+        mark_write(request)
+        self.assertEqual(get_read_database(request, 'replica'), None)
+
+        request.session['datafilters_last_write'] = time.time() - 60
+        self.assertEqual(get_read_database(request, 'replica'), 'replica')
+
+    def test_replica_error(self):
+        cursor = connections['replica'].cursor()
+        cursor.execute('ALTER TABLE polls_poll RENAME TO polls_poll_moved')
+        try:
+            for url in ('/polls/classbased_replica/',
+                        '/polls/decorated_replica/'):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                polls = response.context_data['polls']
+                self.assertEqual(polls.db, 'default')
+                self.assertEqual(len(polls), 4)
+            self.assertEqual(response.context_data['polls_count'], 4)
+        finally:
+            cursor.execute('ALTER TABLE polls_poll_moved RENAME TO polls_poll')
+
+
+unpaginated_replica_poll_list = PollListView.as_view(read_database='replica')
+
+
+@filter_powered(PollsFilterForm, queryset_name='polls',
+                read_database='replica')
+def lazy_replica_poll_list(request):
+    return TemplateResponse(request, 'polls/poll_list.html',
+                            {'polls': Poll.objects.all()})
+
+
+class UnpaginatedReplicaTestCase(TestCase):
+
+    multi_db = True
+
+    def setUp(self):
+        Poll.objects.create(question='Not replicated yet?',
+                            pub_date=datetime.datetime.now())
+
+    def test_replica_error(self):
+        cursor = connections['replica'].cursor()
+        cursor.execute('ALTER TABLE polls_poll RENAME TO polls_poll_moved')
+        try:
+            for view in (unpaginated_replica_poll_list,
+                         lazy_replica_poll_list):
+                request = RequestFactory().get('/')
+                request.user = AnonymousUser()
+                response = view(request)
+                response.render()
+                polls = response.context_data['polls']
+                self.assertEqual(polls.db, 'default')
+                self.assertEqual(len(polls), 4)
+        finally:
+            cursor.execute('ALTER TABLE polls_poll_moved RENAME TO polls_poll')
+
+
+class GuardedPollsFilterForm(PollsFilterForm):
+    statement_timeout = 10000
+
+
+class StatementTimeoutViewTestCase(TestCase):
+
+    def test_mixin(self):
+        request = RequestFactory().get('/', {'has_major_choice': 'true'})
+        request.user = None
+        view = PollListView.as_view(filter_form_cls=GuardedPollsFilterForm,
+                                    paginate_by=10)
+        response = view(request)
+        polls = response.context_data['polls']
+        # The page is already fetched
+        with self.assertNumQueries(0):
+            self.assertEqual([p.pk for p in polls], [1, 3])
+        self.assertTrue(response.context_data['filterform'].is_valid())
+
+        # Unpaginated objects are fetched under the timeout too
+        view = PollListView.as_view(filter_form_cls=GuardedPollsFilterForm)
+        response = view(request)
+        with self.assertNumQueries(0):
+            self.assertEqual([p.pk for p in response.context_data['polls']],
+                             [1, 3])
+
+        # Without the timeout they are left lazy
+        response = PollListView.as_view()(request)
+        self.assertEqual(response.context_data['polls']._result_cache, None)
+
+    def test_decorator(self):
+        view = filter_powered(GuardedPollsFilterForm, queryset_name='polls')(
+            lambda request: {'polls': Poll.objects.all()})
+        request = RequestFactory().get('/', {'has_major_choice': 'true'})
+        polls = view(request)['polls']
+        with self.assertNumQueries(0):
+            self.assertEqual([p.pk for p in polls], [1, 3])
+
+    def test_over_budget(self):
+        class CheapFilterForm(PollsFilterForm):
+            max_cost = 1
+
+        request = RequestFactory().get('/', {'has_major_choice': 'true',
+                                             'question_contains': 'web'})
+        request.user = None
+        view = PollListView.as_view(filter_form_cls=CheapFilterForm)
+        response = view(request)
+        self.assertEqual(list(response.context_data['polls']), [])
+        self.assertFalse(response.context_data['filterform'].is_valid())
+
+        view = filter_powered(CheapFilterForm, queryset_name='polls')(
+            lambda request: {'polls': Poll.objects.all()})
+        self.assertEqual(list(view(request)['polls']), [])
+
+        # Forms are validated before partial filtering
+        form = CheapFilterForm(request.GET)
+        self.assertEqual(list(form.filter_without(Poll.objects.all())), [])
+        form = PollsFilterForm(request.GET)
+        polls = form.filter_only(Poll.objects.all(), 'question_contains')
+        self.assertEqual([p.pk for p in polls], [3])
+
+
+class RememberingFlight(SingleFlight):
+    '''
+    Shares results with requests made before.
+    '''
+
+    def __init__(self):
+        super(RememberingFlight, self).__init__()
+        self.results = {}
+
+    def do(self, key, func):
+        if key not in self.results:
+            self.results[key] = func()
+        return self.results[key]
+
+
+class CoalescedViewTestCase(TestCase):
+
+    def test_coalesce(self):
+        flight = SingleFlight()
+
+        @filter_powered(PollsFilterForm, queryset_name='polls', add_count=True,
+                        aggregate_args={'votes': Sum('choice__votes')},
+                        coalesce=flight)
+        def poll_list(request):
+            return {'polls': Poll.objects.all()}
+
+        request = RequestFactory().get('/', {'has_major_choice': 'true'})
+        context = poll_list(request)
+        self.assertEqual([p.pk for p in context['polls']], [1, 3])
+        self.assertEqual(context['polls_count'], 2)
+        self.assertEqual(context['votes'], 90 + 90 + 100500)
+
+    def test_coalesce_page(self):
+        flight = RememberingFlight()
+
+        @filter_powered(PollsFilterForm, queryset_name='polls', add_count=True,
+                        coalesce=flight, page_size=1,
+                        deferred=lambda polls, context: (polls, context))
+        def poll_list(request):
+            return {'polls': Poll.objects.order_by('pk')}
+
+        request = RequestFactory().get('/', {'has_major_choice': 'true',
+                                             'page': '2'})
+        polls = poll_list(request)['polls']
+        with self.assertNumQueries(0):
+            self.assertEqual([p.pk for p in polls], [3])
+        polls[0].question = 'Changed by the first request'
+
+        with self.assertNumQueries(0):
+            context = poll_list(request)
+            question = context['polls'][0].question
+        self.assertEqual(question, Poll.objects.get(pk=3).question)
+        self.assertEqual(context['polls_count'], 2)
+
+    def test_coalesce_names(self):
+        flight = RememberingFlight()
+
+        def get_view(queryset_name):
+            @filter_powered(PollsFilterForm, queryset_name=queryset_name,
+                            add_count=True, coalesce=flight)
+            def poll_list(request):
+                return {queryset_name: Poll.objects.all()}
+            return poll_list
+
+        request = RequestFactory().get('/', {'has_major_choice': 'true'})
+        self.assertEqual(get_view('polls')(request)['polls_count'], 2)
+        context = get_view('items')(request)
+        self.assertEqual(context['items_count'], 2)
+        self.assertNotIn('polls_count', context)
+
+
+class ConcurrentViewTestCase(TestCase):
+
+    def get_view(self, **kwargs):
+        @filter_powered(PollsFilterForm, queryset_name='polls', add_count=True,
+                        aggregate_args={'votes': Sum('choice__votes')},
+                        **kwargs)
+        def poll_list(request):
+            return {'polls': Poll.objects.all()}
+        return poll_list
+
+    def test_concurrent(self):
+        request = RequestFactory().get('/', {'has_major_choice': 'true'})
+        sequential = self.get_view()(request)
+        context = self.get_view(concurrent=True,
+                                concurrency_timeout=5)(request)
+        # Object list is left lazy
+        self.assertEqual(context['polls']._result_cache, None)
+        self.assertEqual([p.pk for p in context['polls']], [1, 3])
+        self.assertEqual(context['polls_count'], sequential['polls_count'])
+        self.assertEqual(context['votes'], sequential['votes'])
+
+        context = self.get_view(concurrent=True, page_size=1)(request)
+        with self.assertNumQueries(0):
+            self.assertEqual([p.pk for p in context['polls']], [1])
+        self.assertEqual(context['polls_count'], 2)
+
+    def test_in_memory_database(self):
+        # Test database is not visible to other connections
+        self.assertFalse(can_run_concurrently('default'))
+
+
+class AggregateCacheTestCase(TestCase):
+
+    aggregate_args = {
+        'count': Count('pk'),
+        'total': Sum('votes'),
+        'top': Max('votes'),
+        'average': Avg('votes'),
+    }
+
+    def setUp(self):
+        get_filter_cache().clear()
+        self.aggregate_cache = AggregateCache(Choice, dependencies=(Poll,))
+        self.aggregate_cache.connect()
+
+    def tearDown(self):
+        uid = 'datafilters-aggregates-polls.Choice'
+        for model in (Choice, Poll):
+            for signal in (signals.pre_save, signals.post_save,
+                           signals.pre_delete, signals.post_delete):
+                signal.disconnect(sender=model, dispatch_uid=uid)
+
+    def get_aggregates(self):
+        form = ChoicesFilterForm({'poll': '1'})
+        return self.aggregate_cache.aggregate(
+            form.filter(Choice.objects.all()), self.aggregate_args)
+
+    def test_cached(self):
+        expected = {'count': 3, 'total': 120, 'top': 90, 'average': 40.0}
+        self.assertEqual(self.get_aggregates(), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_aggregates(), expected)
+
+    def test_insert(self):
+        self.get_aggregates()
+        Choice.objects.create(poll_id=1, choice_text='More', votes=100)
+        Choice.objects.create(poll_id=2, choice_text='Other poll', votes=1000)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_aggregates(),
+                {'count': 4, 'total': 220, 'top': 100, 'average': 55.0})
+
+    def test_insert_matched_at_once(self):
+        for poll in ('1', '2', '3'):
+            form = ChoicesFilterForm({'poll': poll})
+            self.aggregate_cache.aggregate(form.filter(Choice.objects.all()),
+                                           self.aggregate_args)
+        # The insert and one query matching all cached results
+        with self.assertNumQueries(2):
+            Choice.objects.create(poll_id=2, choice_text='More', votes=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_aggregates()['count'], 3)
+
+    def test_update(self):
+        self.get_aggregates()
+        choice = Choice.objects.get(pk=1)
+        choice.votes = 0
+        choice.save()
+        self.assertEqual(self.get_aggregates()['total'], 110)
+
+        Poll.objects.get(pk=1).save()
+        with self.assertNumQueries(1):
+            self.get_aggregates()
+
+    def test_delete(self):
+        self.get_aggregates()
+        Choice.objects.get(pk=2).delete()
+        Choice.objects.get(pk=4).delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_aggregates(),
+                {'count': 2, 'total': 100, 'top': 90, 'average': 50.0})
+
+        # The maximum is deleted
+        Choice.objects.get(pk=3).delete()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_aggregates(),
+                {'count': 1, 'total': 10, 'top': 10, 'average': 10.0})
+
+        # Sums of no values are None
+        self.aggregate_args = {'count': Count('pk'), 'total': Sum('votes')}
+        self.get_aggregates()
+        Choice.objects.get(pk=1).delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_aggregates(),
+                             {'count': 0, 'total': None})
+
+    def test_concurrent_change(self):
+        self.get_aggregates()
+        choice = Choice(poll_id=1, choice_text='More', votes=100)
+        # A change started by another process
+        self.aggregate_cache.begin_change(Choice(poll_id=1))
+        choice.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_aggregates()['count'], 4)
+
+
+class MatchFiltersTestCase(TestCase):
+
+    filters = {
+        'major': {'has_major_choice': 'true'},
+        'framework': {'question_contains': 'framework'},
+        'flask': {'choice_contains': 'flask', 'has_exact_votes': '35'},
+        'nothing': {'choice_contains': 'nothing at all'},
+        'everything': {},
+        'invalid': {'pub_date': 'yesterday'},
+    }
+
+    def test_match(self):
+        forms = dict((key, PollsFilterForm(data))
+                     for key, data in self.filters.items())
+        with self.assertNumQueries(2):
+            matches = match_filters(forms, Poll.objects.all(), chunk_size=3)
+
+        expected = {}
+        for key, form in forms.items():
+            if form.is_valid():
+                for poll in form.filter(Poll.objects.all()).distinct():
+                    expected.setdefault(poll.pk, []).append(key)
+
+        self.assertEqual(sorted(matches), sorted(expected))
+        for pk, keys in matches.items():
+            self.assertItemsEqual(keys, expected[pk])
+        self.assertItemsEqual(matches[3], ['major', 'framework', 'flask',
+                                           'everything'])
+
+    def test_candidates(self):
+        forms = [PollsFilterForm({'has_major_choice': 'true'})]
+        self.assertEqual(match_filters(forms, Poll.objects.filter(pk=1)),
+                         {1: [0]})
+        self.assertEqual(match_filters(forms, Poll.objects.filter(pk=2)), {})
+
+
+class ConditionalGetTestCase(TestCase):
+
+    def get(self, view, headers=None):
+        request = RequestFactory().get('/', {'has_major_choice': 'true'},
+                                       **(headers or {}))
+        request.user = AnonymousUser()
+        return view(request)
+
+    def test_last_modified_field(self):
+        view = PollListView.as_view(last_modified_field='pub_date')
+        response = self.get(view)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(response['Last-Modified'],
+                         'Sun, 01 Jan 2012 21:00:00 GMT')
+
+        with self.assertNumQueries(1):
+            response = self.get(view, {'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response['Last-Modified'],
+                         'Sun, 01 Jan 2012 21:00:00 GMT')
+
+        response = self.get(view, {
+            'HTTP_IF_MODIFIED_SINCE': 'Mon, 02 Jan 2012 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 304)
+
+        # A poll with old date changes number of filtered objects
+        poll = Poll.objects.create(question='Old?',
+                                   pub_date=datetime.datetime(2010, 1, 1))
+        poll.choice_set.create(choice_text='Many', votes=1000)
+        response = self.get(view, {'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_version_models(self):
+        view = PollListView.as_view(version_models=(Poll, Choice))
+        etag = self.get(view)['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.get(view, {'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual(response.status_code, 304)
+
+        Choice.objects.filter(pk=1)[0].save()
+        response = self.get(view, {'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual(response.status_code, 200)
+
+
+class VotesAboveSpec(FilterSpec):
+
+    def to_lookup(self, value):
+        if not value:
+            return Extra()
+        return Extra(conditions=[Condition(self.field_name,
+                                           '{column} > %s', [int(value)])])
+
+
+class QuestionLengthSpec(FilterSpec):
+
+    def to_lookup(self, value):
+        if not value:
+            return Extra()
+        return Extra(where=['length(polls_poll.question) > %s'],
+                     params=[int(value)])
+
+
+class ExtraFilterForm(FilterForm):
+    votes_above = VotesAboveSpec('choice__votes')
+    other_votes_above = VotesAboveSpec('choice__votes')
+    question_longer = QuestionLengthSpec('question')
+
+
+class ExtraLookupTestCase(TestCase):
+
+    def filter(self, data):
+        form = ExtraFilterForm(data)
+        self.assertTrue(form.is_valid())
+        polls = form.filter(Poll.objects.all()).distinct()
+        return sorted(poll.pk for poll in polls)
+
+    def test_condition(self):
+        self.assertEqual(self.filter({'votes_above': '50'}), [1, 3])
+        self.assertEqual(self.filter({'votes_above': '100'}), [3])
+        # Identical conditions are applied once
+        self.assertEqual(self.filter({'votes_above': '100',
+                                      'other_votes_above': '100'}), [3])
+
+    def test_params(self):
+        self.assertEqual(self.filter({'question_longer': '11'}), [3])
+        self.assertEqual(self.filter({'question_longer': '11',
+                                      'votes_above': '50'}), [3])
+
+
+class HintedChoicesFilterForm(ChoicesFilterForm):
+    select_related = ('poll',)
+    only = ('choice_text', 'poll__question')
+
+    text_contains = ContainsFilterSpec('choice_text',
+                                       prefetch_related=('poll__choice_set',))
+
+
+class QueryHintsTestCase(TestCase):
+
+    def test_form_hints(self):
+        form = HintedChoicesFilterForm({'poll': '1'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.get_query_hints(), {
+            'select_related': ['poll'],
+            'prefetch_related': [],
+            'only': ['choice_text', 'poll__question'],
+        })
+        choices = form.apply_query_hints(form.filter(Choice.objects.all()))
+        with self.assertNumQueries(1):
+            self.assertEqual([c.poll.question for c in choices],
+                             ["What's up?"] * 3)
+
+    def test_active_spec_hints(self):
+        form = HintedChoicesFilterForm({'text_contains': 'hacking'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.get_query_hints()['prefetch_related'],
+                         ['poll__choice_set'])
+
+        @filter_powered(HintedChoicesFilterForm, queryset_name='choices')
+        def choice_list(request):
+            return {'choices': Choice.objects.all()}
+
+        request = RequestFactory().get('/', {'text_contains': 'hacking'})
+        choices = choice_list(request)['choices']
+        with self.assertNumQueries(2):
+            self.assertEqual([len(c.poll.choice_set.all()) for c in choices],
+                             [3, 2])
+
+
+class FilterParserTestCase(TestCase):
+
+    def assertSameLookups(self, filterform_cls, data):
+        form = filterform_cls(QueryDict(data))
+        parsed = FilterParser(filterform_cls).parse(QueryDict(data))
+        self.assertTrue(form.is_valid())
+        self.assertTrue(parsed.is_valid())
+        self.assertEqual(parsed.get_lookup_args(), form.get_lookup_args())
+        self.assertEqual(parsed.get_extra_conditions().as_kwargs(),
+                         form.get_extra_conditions().as_kwargs())
+        self.assertEqual(parsed.get_extra_conditions().conditions,
+                         form.get_extra_conditions().conditions)
+        self.assertEqual(
+            [(name, value) for name, (value, _l)
+             in parsed.active_specs.items()],
+            [(name, value) for name, (value, _l)
+             in form.active_specs.items()])
+
+    def test_same_lookups(self):
+        self.assertSameLookups(PollsFilterForm, '')
+        self.assertSameLookups(PollsFilterForm,
+                               'has_major_choice=true&pub_date=this_year'
+                               '&question_contains=web&has_exact_votes=10')
+        self.assertSameLookups(ChoicesFilterForm, 'poll=1&text_contains=a')
+        self.assertSameLookups(ExtraFilterForm,
+                               'votes_above=50&question_longer=11')
+
+    def test_filter(self):
+        parsed = FilterParser(PollsFilterForm).parse(
+            {'has_major_choice': 'true'})
+        polls = parsed.filter(Poll.objects.all()).distinct()
+        self.assertEqual(sorted(p.pk for p in polls), [1, 3])
+
+    def test_errors(self):
+        parsed = FilterParser(ChoicesFilterForm).parse({'poll': 'first'})
+        self.assertFalse(parsed.is_valid())
+        self.assertEqual(parsed.errors.keys(), ['poll'])
+        self.assertEqual(parsed.get_lookup_args(), ((), {}))
+
+        class CheapFilterForm(PollsFilterForm):
+            max_cost = 1
+
+        parsed = FilterParser(CheapFilterForm).parse(
+            {'has_major_choice': 'true', 'question_contains': 'web'})
+        self.assertEqual(parsed.errors.keys(), [NON_FIELD_ERRORS])
+
+    def test_unsupported_form(self):
+        class CustomFilterForm(PollsFilterForm):
+            def clean_question_contains(self):
+                return self.cleaned_data['question_contains'].strip()
+
+        self.assertRaises(ImproperlyConfigured, FilterParser,
+                          CustomFilterForm)
+
+        class CleanFilterForm(PollsFilterForm):
+            def clean(self):
+                return super(CleanFilterForm, self).clean()
+
+        self.assertRaises(ImproperlyConfigured, FilterParser,
+                          CleanFilterForm)
+
+
+class CustomQuerySet(QuerySet):
+    pass
+
+
+class FilterStatsTestCase(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.collector = FilterStatsCollector(SQLiteStatsStorage(self.path),
+                                              flush_interval=3600)
+
+        class TrackedPollsFilterForm(PollsFilterForm):
+            stats_collector = self.collector
+
+        self.form_cls = TrackedPollsFilterForm
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_fingerprint(self):
+        form = self.form_cls({'has_major_choice': 'true',
+                              'question_contains': 'secret'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(fingerprint(form),
+                         'has_major_choice:unicode&question_contains:unicode')
+
+    def test_collect(self):
+        form = self.form_cls({'has_major_choice': 'true'})
+        polls = form.filter(Poll.objects.all()).distinct()
+        self.assertEqual(polls.count(), 2)
+        self.assertEqual(len(polls.values('pk')), 2)
+        self.assertEqual(len(polls), 2)
+
+        stats = self.collector.stats['has_major_choice:unicode']
+        self.assertEqual(stats['uses'], 1)
+        self.assertEqual(stats['queries'], 3)
+        self.assertEqual(sum(stats['histogram'].values()), 3)
+
+        self.collector.flush()
+        self.assertEqual(self.collector.stats, {})
+        self.form_cls({}).filter(Poll.objects.all()).count()
+        self.collector.flush()
+
+        stored = SQLiteStatsStorage(self.path).load()
+        self.assertEqual(stored['has_major_choice:unicode']['queries'], 3)
+        self.assertEqual(stored['']['uses'], 1)
+
+        output = StringIO()
+        call_command('filter_stats', file=self.path, stdout=output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith('has_major_choice:unicode') or
+                        lines[2].endswith('has_major_choice:unicode'))
+
+    def test_pickle(self):
+        form = self.form_cls({'has_major_choice': 'true'})
+        for queryset in (Poll.objects.all(), CustomQuerySet(Poll),
+                         Poll.objects.values('pk')):
+            polls = form.filter(queryset).distinct()
+            self.assertNotIn(self.collector, polls.__dict__.values())
+            copy.deepcopy(polls)
+
+            restored = pickle.loads(pickle.dumps(polls))
+            self.assertTrue(isinstance(restored, queryset.__class__))
+            self.assertEqual(restored._stats, None)
+            self.assertEqual(list(restored), list(polls))
+
+
+class VotesFilterForm(ChoicesFilterForm):
+    votes = RangeFilterSpec('votes', base_field=forms.IntegerField)
+
+
+class RangeFilterTestCase(TestCase):
+
+    def setUp(self):
+        get_filter_cache().clear()
+
+    def test_filter(self):
+        form = VotesFilterForm({'votes_0': '15', 'votes_1': '100'})
+        choices = form.filter(Choice.objects.all())
+        self.assertEqual(sorted(c.votes for c in choices), [20, 35, 90, 90])
+
+    def test_histogram(self):
+        form = VotesFilterForm({'poll': '1', 'votes_0': '15'})
+        self.assertTrue(form.is_valid())
+        spec = form.filter_specs['votes']
+        # Range itself is not applied
+        self.assertEqual(spec.histogram(form, Choice.objects.all(), 50),
+                         [(0, 2), (50, 1)])
+        with self.assertNumQueries(0):
+            spec.histogram(form, Choice.objects.all(), 50)
+        self.assertEqual(
+            VotesFilterForm.filter_specs_base['votes'].histogram(
+                form, Choice.objects.all(), 25, bounds=(0, 100)),
+            [(0, 2), (25, 0), (50, 0), (75, 1)])
+
+
+class ShardingTestCase(TestCase):
+
+    multi_db = True
+
+    def setUp(self):
+        # Both shards start with the same fixture data
+        poll = Poll.objects.using('replica').create(
+            question='Who is on the other shard?',
+            pub_date=datetime.datetime(2012, 2, 1))
+        poll.choice_set.create(choice_text='Me', votes=70)
+        poll.choice_set.create(choice_text='Nobody', votes=5)
+
+    def get_polls(self, data, queryset=None):
+        form = PollsFilterForm(data)
+        if queryset is None:
+            queryset = Poll.objects.order_by('-pub_date', 'pk')
+        return form.filter_sharded(queryset,
+                                   using=('default', 'replica')).distinct()
+
+    def test_count(self):
+        self.assertEqual(self.get_polls({}).count(), 7)
+        self.assertEqual(self.get_polls({'has_major_choice': 'true'}).count(),
+                         5)
+
+    def test_merged_ordering(self):
+        polls = self.get_polls({'has_major_choice': 'true'})
+        self.assertEqual([(p._state.db, p.pk) for p in polls],
+                         [('replica', 4), ('default', 1), ('replica', 1),
+                          ('default', 3), ('replica', 3)])
+        self.assertEqual([(p._state.db, p.pk) for p in polls[1:3]],
+                         [('default', 1), ('replica', 1)])
+        self.assertEqual(polls[0].question, 'Who is on the other shard?')
+
+        polls = self.get_polls({}, Poll.objects.values('question', 'pk')
+                                               .order_by('question', '-pk'))
+        self.assertEqual([p['pk'] for p in polls[:4]], [3, 3, 2, 2])
+
+    def test_related_ordering(self):
+        choices = ShardedQuerySet.from_queryset(
+            Choice.objects.order_by('-poll__pub_date', 'pk'),
+            ('default', 'replica'))
+        # Polls are selected with the choices
+        with self.assertNumQueries(1):
+            dates = [c.poll.pub_date for c in choices[:6]]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+        with self.assertNumQueries(1):
+            self.assertEqual(len([c.poll.question for c in choices]), 20)
+
+    def test_aggregate(self):
+        choices = ShardedQuerySet.from_queryset(Choice.objects.all(),
+                                                ('default', 'replica'))
+        self.assertEqual(choices.aggregate(
+            total=Sum('votes'), count=Count('pk'), top=Max('votes'),
+            average=Avg('votes')), {
+                'total': 2 * 100761 + 75,
+                'count': 20,
+                'top': 100500,
+                'average': (2 * 100761 + 75) / 20.0,
+            })
+        self.assertRaises(ValueError, choices.aggregate,
+                          n=Count('poll', distinct=True))
+
+
+class CountingSession(dict):
+    '''
+    Session counting writes.
+    '''
+
+    writes = 0
+
+    def __setitem__(self, key, value):
+        self.writes += 1
+        super(CountingSession, self).__setitem__(key, value)
+
+
+class RefinementCacheTestCase(TestCase):
+
+    def setUp(self):
+        get_filter_cache().clear()
+        self.refinement = RefinementCache(Poll, dependencies=(Choice,))
+        self.request = RequestFactory().get('/')
+        self.request.session = CountingSession()
+
+    def filter(self, data):
+        form = PollsFilterForm(data)
+        self.assertTrue(form.is_valid())
+        polls = self.refinement.filter(self.request, form, Poll.objects.all())
+        return sorted(poll.pk for poll in polls)
+
+    def get_states(self):
+        return self.request.session[RefinementCache.session_key]['states']
+
+    def tamper(self, ids):
+        # Make remembered results distinguishable from fresh ones
+        for state in self.get_states():
+            get_filter_cache().set(state['key'], ids)
+
+    def test_refine(self):
+        self.assertEqual(self.filter({'question_contains': 'what'}),
+                         [1, 2, 3])
+        self.tamper([1, 2])
+        self.assertEqual(self.filter({'question_contains': 'what',
+                                      'has_major_choice': 'true'}), [1])
+        self.assertEqual([get_filter_cache().get(s['key'])
+                          for s in self.get_states()], [[1], [1, 2]])
+        self.assertEqual(self.request.session.writes, 2)
+
+        # Repeated state is not written, only the objects are fetched
+        with self.assertNumQueries(1):
+            self.assertEqual(self.filter({'question_contains': 'what'}),
+                             [1, 2])
+        self.assertEqual(self.request.session.writes, 2)
+
+    def test_evicted(self):
+        self.filter({'question_contains': 'what'})
+        get_filter_cache().clear()
+        self.assertEqual(self.filter({'question_contains': 'what',
+                                      'has_major_choice': 'true'}), [1, 3])
+
+    def test_oversized(self):
+        self.refinement.max_ids = 2
+        self.assertEqual(self.filter({'question_contains': 'what'}),
+                         [1, 2, 3])
+        self.assertEqual(self.request.session.writes, 1)
+        # Keys are not probed again
+        with self.assertNumQueries(1):
+            self.filter({'question_contains': 'what'})
+        self.assertEqual(self.request.session.writes, 1)
+
+        # Narrower filters still fit
+        self.assertEqual(self.filter({'question_contains': 'what',
+                                      'has_major_choice': 'true'}), [1, 3])
+        self.assertEqual(len(self.get_states()), 2)
+
+    def test_multivalued_specs(self):
+        self.filter({'has_major_choice': 'true'})
+        self.tamper([1])
+        # Both specs must hold for the same choice
+        self.assertEqual(self.filter({'has_major_choice': 'true',
+                                      'choice_contains': 'sky'}), [])
+        self.assertEqual(self.filter({'has_major_choice': 'true',
+                                      'choice_contains': 'django'}), [3])
+
+    def test_invalidation(self):
+        self.filter({'question_contains': 'what'})
+        self.tamper([1])
+        Choice.objects.filter(pk=1)[0].save()
+        self.assertEqual(self.filter({'question_contains': 'what',
+                                      'has_major_choice': 'true'}), [1, 3])
+
+    def test_decorator(self):
+        @filter_powered(PollsFilterForm, queryset_name='polls',
+                        refinement_cache=self.refinement)
+        def poll_list(request):
+            return {'polls': Poll.objects.all()}
+
+        request = RequestFactory().get('/', {'question_contains': 'what'})
+        request.session = self.request.session
+        self.assertEqual(len(poll_list(request)['polls']), 3)
+        self.assertEqual(len(self.get_states()), 1)
+
+
+warmed_choice_stats = AggregateCache(Choice, dependencies=(Poll,))
+
+
+@filter_powered(ChoicesFilterForm, queryset_name='choices',
+                aggregate_args={'votes': Sum('votes')},
+                aggregate_cache=warmed_choice_stats)
+def warmed_choice_list(request):
+    return {'choices': Choice.objects.all()}
+
+
+warmed_choice_results = FilterResultCache(Choice, dependencies=(Poll,))
+
+
+@filter_powered(ChoicesFilterForm, queryset_name='choices', add_count=True,
+                aggregate_args={'votes': Sum('votes')}, page_size=2,
+                result_cache=warmed_choice_results)
+def warmed_result_list(request):
+    return {'choices': Choice.objects.all()}
+
+
+class WarmFilterCacheTestCase(TestCase):
+
+    def setUp(self):
+        get_filter_cache().clear()
+
+    def test_warm(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('# popular filters\n\n'
+                    'polls.tests.warmed_choice_list?poll=3\n')
+        output = StringIO()
+        try:
+            call_command('warm_filter_cache',
+                         '/polls/decorated/?has_major_choice=true',
+                         'polls.views.PollListView?question_contains=web',
+                         file=path, stdout=output)
+        finally:
+            os.unlink(path)
+
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].endswith(
+            '200  /polls/decorated/?has_major_choice=true'))
+        self.assertTrue(lines[1].endswith(
+            '200  polls.views.PollListView?question_contains=web'))
+        self.assertTrue(lines[2].endswith(
+            "-  polls.tests.warmed_choice_list?poll=3"))
+
+        with self.assertNumQueries(0):
+            stats = warmed_choice_stats.aggregate(
+                Choice.objects.filter(poll=3).distinct(),
+                {'votes': Sum('votes')})
+        self.assertEqual(stats, {'votes': 100625})
+
+    def test_warm_form_results(self):
+        output = StringIO()
+        call_command('warm_filter_cache', 'polls.filters.ChoicesFilterForm',
+                     'polls.filters.ChoicesFilterForm:polls.models.Choice'
+                     '?poll=3',
+                     result_cache='polls.tests.warmed_choice_results',
+                     aggregates=['votes=Sum:votes'], page_size=2,
+                     stdout=output)
+        self.assertEqual(len(output.getvalue().splitlines()), 3)
+
+        with self.assertNumQueries(0):
+            list(ChoicesFilterForm().fields['poll'].choices)
+            context = warmed_result_list(
+                RequestFactory().get('/', {'poll': '3'}))
+        self.assertEqual(context['choices_count'], 4)
+        self.assertEqual(context['votes'], 100625)
+        self.assertEqual(len(context['choices']), 2)
+
+        # Other pages are not warmed
+        with self.assertNumQueries(1):
+            warmed_result_list(RequestFactory().get('/', {'poll': '3',
+                                                          'page': '2'}))
+
+        Choice.objects.create(poll_id=3, choice_text='Other', votes=1)
+        context = warmed_result_list(RequestFactory().get('/', {'poll': '3'}))
+        self.assertEqual(context['choices_count'], 5)
+
+    def test_errors(self):
+        command = warm_filter_cache.Command()
+        self.assertRaises(CommandError, command.get_view,
+                          'polls.filters.PollsFilterForm:polls.models.Poll')
+        self.assertRaises(CommandError, command.get_view,
+                          'polls.views.PollListView:polls.models.Poll')
+        self.assertRaises(CommandError, command.get_view, '/no/such/page/')
@@ -15,6 +15,8 @@ class PollListView(FilterFormMixin, ListView):
 
 class_based_poll_list = PollListView.as_view()
 class_based_chaining_poll_list = PollListView.as_view(use_filter_chaining=True)
+class_based_replica_poll_list = PollListView.as_view(read_database='replica',
+                                                    paginate_by=10)
 
 
 @filter_powered(PollsFilterForm, queryset_name='polls')
@@ -22,3 +24,11 @@ def decorated_poll_list(request):
     return TemplateResponse(request,
                             'polls/poll_list.html',
                             {'polls': Poll.objects.all()})
+
+
+@filter_powered(PollsFilterForm, queryset_name='polls', add_count=True,
+                read_database='replica')
+def decorated_replica_poll_list(request):
+    return TemplateResponse(request,
+                            'polls/poll_list.html',
+                            {'polls': Poll.objects.all()})
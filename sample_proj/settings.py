@@ -7,7 +7,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3', # Add 'postgresql_psycopg2', 'mysql', 'sqlite3' or 'oracle'.
         'NAME': 'test.db',                      # Or path to database file if using sqlite3.
-    }
+    },
+    # Read replica for filtered queries (see datafilters.routing)
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'replica.db',
+    },
 }
 
 USE_I18N = True
@@ -7,5 +7,7 @@ urlpatterns = patterns('',
     url(r'^polls/decorated/$', 'polls.views.decorated_poll_list', name='decorated'),
     url(r'^polls/classbased/$', 'polls.views.class_based_poll_list', name='class_based'),
     url(r'^polls/classbased_chaining/$', 'polls.views.class_based_chaining_poll_list', name='class_based_chaining'),
+    url(r'^polls/decorated_replica/$', 'polls.views.decorated_replica_poll_list', name='decorated_replica'),
+    url(r'^polls/classbased_replica/$', 'polls.views.class_based_replica_poll_list', name='class_based_replica'),
     url(r'^admin/', include(admin.site.urls)),
 )
@@ -9,6 +9,7 @@ setup(
     package_data = {'': [
         'locale/*/LC_MESSAGES/django.po',
         'locale/*/LC_MESSAGES/django.mo',
+        'templates/datafilters/*.html',
     ]},
 
     # Metadata